@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Content-addressed caches on the network volume
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+
+
+# Reference images keyed by SHA-256, shared by every worker on the volume
+INPUT_CACHE_DIR = os.environ.get("INPUT_CACHE_DIR", "/runpod-volume/cache/inputs")
+INPUT_CACHE_MAX_BYTES = int(os.environ.get("INPUT_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+
+# Finished workflow outputs keyed by a hash of the canonical graph
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/runpod-volume/cache/results")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+# Content hashes of files already on disk, keyed by (path, size, mtime)
+file_hashes = {}
+
+# Cache directories with an eviction pass in flight
+evictions_running = set()
+evictions_lock = threading.Lock()
+
+
+def sha256_bytes(data):
+    """Hex SHA-256 of a bytes object"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_sha256(path):
+    """Hex SHA-256 of a file, memoized until the file changes"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+
+    if key not in file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        file_hashes[key] = digest.hexdigest()
+
+    return file_hashes[key]
+
+
+def is_sha256(value):
+    """True if value looks like a hex SHA-256 digest"""
+    return isinstance(value, str) and SHA256_PATTERN.fullmatch(value) is not None
+
+
+def write_atomic(path, data):
+    """Write bytes to path via a temp file so readers never see a partial file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+
+    os.replace(tmp_path, path)
+
+
+def touch(path):
+    """Mark a cache entry as recently used (atime is unreliable on network volumes)"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def cached_input_path(digest):
+    """Location of a cached input; the first two hex chars shard the directory"""
+    return os.path.join(INPUT_CACHE_DIR, digest[:2], digest)
+
+
+def get_cached_input(digest):
+    """Return the cached file for a digest, or None if it isn't cached"""
+    if not INPUT_CACHE_DIR or not is_sha256(digest):
+        return None
+
+    path = cached_input_path(digest)
+    if not os.path.exists(path):
+        return None
+
+    touch(path)
+    return path
+
+
+def store_cached_input(data, digest=None):
+    """Add bytes to the input cache and return their digest, or None if the cache is disabled"""
+    if not INPUT_CACHE_DIR:
+        return None
+
+    digest = digest or sha256_bytes(data)
+
+    if get_cached_input(digest) is None:
+        write_atomic(cached_input_path(digest), data)
+        schedule_eviction(INPUT_CACHE_DIR, evict_lru, INPUT_CACHE_MAX_BYTES)
+
+    return digest
+
+
+def link_cached_input(digest, destination):
+    """
+    Expose a cached input at destination without copying it
+
+    Hard links only work within one filesystem and the volume is usually a
+    different mount than /comfyui, so fall back to a symlink.
+    """
+    source = cached_input_path(digest)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+    except OSError:
+        os.symlink(source, destination)
+
+
+def evict_lru(cache_dir, max_bytes):
+    """Delete least recently used files until the cache fits in max_bytes"""
+    entries = []
+    total_bytes = 0
+
+    for root, dirs, files in os.walk(cache_dir):
+        for filename in files:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+
+    if total_bytes <= max_bytes:
+        return
+
+    entries.sort()
+    for mtime, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total_bytes -= size
+            print(f"Evicted from cache: {path}")
+        except FileNotFoundError:
+            pass
+
+
+def result_entry_dir(key):
+    """Directory holding one cached workflow result"""
+    return os.path.join(RESULT_CACHE_DIR, key)
+
+
+def get_cached_result(key):
+    """
+    Return a cached result, or None on a miss or an expired entry
+
+    The result is {"prompt_id": ..., "outputs": [{"node_id": ..., "files": [...]}]}
+    with absolute file paths.
+
+    Entries expire RESULT_CACHE_TTL seconds after they were last used (the
+    manifest mtime, refreshed on every hit), matching evict_results.
+    """
+    if not RESULT_CACHE_DIR:
+        return None
+
+    entry_dir = result_entry_dir(key)
+    manifest_path = os.path.join(entry_dir, "manifest.json")
+
+    try:
+        last_used = os.path.getmtime(manifest_path)
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - last_used > RESULT_CACHE_TTL:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+
+    touch(manifest_path)
+
+    for output in manifest["outputs"]:
+        output["files"] = [os.path.join(entry_dir, path) for path in output["files"]]
+
+    return manifest
+
+
+def store_cached_result(key, prompt_id, node_outputs, source_dir):
+    """
+    Copy a job's output files into the result cache
+
+    node_outputs is a list of (node_id, files relative to source_dir). The
+    entry is assembled in a temp dir and renamed so readers never see half of it.
+    """
+    if not RESULT_CACHE_DIR:
+        return
+
+    entry_dir = result_entry_dir(key)
+    if os.path.exists(entry_dir):
+        return
+
+    tmp_dir = f"{entry_dir}.{uuid.uuid4().hex}.tmp"
+    outputs = []
+
+    try:
+        for node_id, files in node_outputs:
+            stored_files = []
+            for filename in files:
+                stored_path = os.path.join("files", str(node_id), os.path.basename(filename))
+                os.makedirs(os.path.join(tmp_dir, os.path.dirname(stored_path)), exist_ok=True)
+                shutil.copyfile(os.path.join(source_dir, filename), os.path.join(tmp_dir, stored_path))
+                stored_files.append(stored_path)
+            outputs.append({"node_id": node_id, "files": stored_files})
+
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump({"created": time.time(), "prompt_id": prompt_id, "outputs": outputs}, f)
+
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        # Another worker stored the same result first
+        if os.path.exists(entry_dir):
+            return
+        raise
+
+    schedule_eviction(RESULT_CACHE_DIR, evict_results, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+
+def evict_results(cache_dir, max_bytes, ttl):
+    """Drop expired result entries, then least recently used ones until under max_bytes"""
+    now = time.time()
+    entries = []
+    total_bytes = 0
+
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir() or entry.name.endswith(".tmp"):
+            continue
+
+        try:
+            last_used = os.path.getmtime(os.path.join(entry.path, "manifest.json"))
+        except FileNotFoundError:
+            continue
+
+        if now - last_used > ttl:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+
+        size = 0
+        for root, dirs, files in os.walk(entry.path):
+            for filename in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, filename))
+                except FileNotFoundError:
+                    pass
+
+        entries.append((last_used, size, entry.path))
+        total_bytes += size
+
+    entries.sort()
+    for last_used, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total_bytes -= size
+        print(f"Evicted cached result: {path}")
+
+
+def schedule_eviction(cache_dir, evict, *args):
+    """Run evict(cache_dir, *args) in the background unless one is already running for cache_dir"""
+    with evictions_lock:
+        if cache_dir in evictions_running:
+            return
+        evictions_running.add(cache_dir)
+
+    def run():
+        try:
+            evict(cache_dir, *args)
+        except OSError as e:
+            print(f"Cache eviction failed for {cache_dir}: {e}")
+        finally:
+            with evictions_lock:
+                evictions_running.discard(cache_dir)
+
+    threading.Thread(target=run, name="cache-eviction", daemon=True).start()
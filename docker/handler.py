@@ -9,157 +9,1041 @@ HANDLER_VERSION = "3.0-runpod-volume"  # Version marker for debugging
 import runpod
 import json
 import os
+import re
 import sys
 import time
+import asyncio
 import subprocess
 import requests
 import base64
+import uuid
+import threading
+from io import BytesIO
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from utils import download_models, upload_to_s3, cleanup_outputs
+from utils import download_models, submit_s3_upload
+from janitor import start_janitor, schedule_removal, protect, release
+from models import (
+    MODEL_LOADER_INPUTS, model_dirs, get_model_paths_configs, find_model_file, find_source_model_file,
+    get_manifest, find_workflow_models, prefetch_models, promote_models, start_readahead, get_model_size
+)
+from residency import RESIDENCY_MANAGER, ResidencyManager
+from validation import WorkflowValidator
+from cache import (
+    RESULT_CACHE_DIR, sha256_bytes, file_sha256, get_cached_input, store_cached_input,
+    link_cached_input, get_cached_result, store_cached_result
+)
 
-# ComfyUI path
-COMFYUI_PATH = "/comfyui"
+try:
+    import websocket  # websocket-client
+except ImportError:
+    websocket = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# ComfyUI path - override to run the handler against a stand-in server's folders
+COMFYUI_PATH = os.environ.get("COMFYUI_PATH", "/comfyui")
 COMFYUI_OUTPUT = f"{COMFYUI_PATH}/output"
 COMFYUI_INPUT = f"{COMFYUI_PATH}/input"
 COMFYUI_PYTHON = "/comfyui/.venv/bin/python"
 
+# ComfyUI API endpoint - override to point the handler at a stand-in server
+COMFYUI_URL = os.environ.get("COMFYUI_URL", "http://localhost:8188")
+COMFYUI_CONNECT_TIMEOUT = float(os.environ.get("COMFYUI_CONNECT_TIMEOUT", "5"))
+COMFYUI_READ_TIMEOUT = float(os.environ.get("COMFYUI_READ_TIMEOUT", "30"))
+
+# Completion waiting - websocket events first, /history polling as fallback
+PROMPT_TIMEOUT = 300  # 5 minutes max
+WS_RECV_TIMEOUT = 5  # Re-check /history this often in case an event was missed
+POLL_INTERVAL = 2
+
+# Worker warm start - ComfyUI is started and models loaded before jobs are accepted
+COMFYUI_START_TIMEOUT = float(os.environ.get("COMFYUI_START_TIMEOUT", "120"))
+# Comma-separated checkpoint names, "none" to disable; unset = scan WORKFLOWS_DIR
+WARMUP_CHECKPOINTS = os.environ.get("WARMUP_CHECKPOINTS")
+WORKFLOWS_DIR = os.environ.get("WORKFLOWS_DIR", "/runpod-volume/workflows")
+# Comma-separated type/name model files to page in at boot, "none" to disable; unset = scan WORKFLOWS_DIR
+READAHEAD_MODELS = os.environ.get("READAHEAD_MODELS")
+
+# ComfyUI stdout/stderr is drained into a ring buffer so the pipes never fill up
+COMFYUI_LOG_LINES = int(os.environ.get("COMFYUI_LOG_LINES", "1000"))
+COMFYUI_LOG_TAIL = int(os.environ.get("COMFYUI_LOG_TAIL", "50"))  # Lines attached to errors
+# Also forward ComfyUI output to the worker log at this level (debug/info/warn/error)
+COMFYUI_LOG_LEVEL = os.environ.get("COMFYUI_LOG_LEVEL", "").lower()
+
+# Concurrent jobs per worker - all of them queue into the single ComfyUI server
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "2"))
+
+# Register the streaming handler that yields images per output node
+STREAM_OUTPUTS = os.environ.get("STREAM_OUTPUTS", "").lower() in ("1", "true", "yes")
+
+# Output encoding - re-encoding runs on a thread pool across a job's outputs
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", "4"))
+# Read outputs through ComfyUI's /view endpoint instead of its output directory
+FETCH_OUTPUTS_VIA_VIEW = os.environ.get("FETCH_OUTPUTS_VIA_VIEW", "").lower() in ("1", "true", "yes")
+OUTPUT_EXTENSIONS = {
+    "raw": None,
+    "png": ".png",
+    "webp": ".webp",
+    "jpeg": ".jpg"
+}
+
 # Models path - RunPod mounts network volumes at /runpod-volume
 MODELS_PATH = "/runpod-volume/comfyui/models"
 
-# ComfyUI server process
+# Bump to invalidate every cached result when the cache key recipe changes
+RESULT_CACHE_VERSION = 1
+
+# ComfyUI server process, or True in comfyui_external when using a server we didn't start
 comfyui_process = None
+comfyui_external = False
+comfyui_start_lock = threading.Lock()
 
+encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
 
-def start_comfyui_server():
-    """Start ComfyUI server in background"""
-    global comfyui_process
-
-    if comfyui_process is None:
-        print("Starting ComfyUI server...")
-        print(f"Models path: {MODELS_PATH}")
-
-        # Point ComfyUI to the network storage models location
-        comfyui_process = subprocess.Popen(
-            [COMFYUI_PYTHON, "main.py",
-             "--listen", "0.0.0.0",
-             "--port", "8188",
-             "--input-directory", COMFYUI_INPUT,
-             "--output-directory", COMFYUI_OUTPUT,
-             # Use base path for models on network storage
-             "--extra-model-paths-config", "/model_paths.yaml"],
-            cwd=COMFYUI_PATH,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+# Recent ComfyUI output lines
+comfyui_log = deque(maxlen=COMFYUI_LOG_LINES)
+comfyui_log_lock = threading.Lock()
+
+
+def pump_comfyui_output(stream, name):
+    """Drain one of ComfyUI's output pipes into the log ring"""
+    forward = None
+    if COMFYUI_LOG_LEVEL:
+        forward = getattr(runpod.RunPodLogger(), COMFYUI_LOG_LEVEL, None)
+
+    for raw_line in iter(stream.readline, b""):
+        line = raw_line.decode("utf-8", errors="replace").rstrip()
+        if not line:
+            continue
+
+        with comfyui_log_lock:
+            comfyui_log.append(f"[{name}] {line}")
+
+        if forward is not None:
+            forward(f"[comfyui {name}] {line}")
+
+    stream.close()
+
+
+def get_comfyui_log_tail(lines=COMFYUI_LOG_TAIL):
+    """Return the most recent ComfyUI output lines"""
+    with comfyui_log_lock:
+        return list(comfyui_log)[-lines:]
+
+
+def check_comfyui_alive():
+    """Fail fast instead of waiting out the timeout if ComfyUI has died"""
+    if comfyui_process is not None and comfyui_process.poll() is not None:
+        raise Exception(f"ComfyUI process exited (code {comfyui_process.returncode})")
+
+
+class JobTimer:
+    """
+    Monotonic per-stage timings for one job
+
+    Stages are timed with stage(); ComfyUI execution events fed to on_event()
+    add the queue wait, execution time and per-node durations.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+        self.nodes = {}
+        self.queued_at = None
+        self.current_node = None
+        self.node_started = None
+
+    @contextmanager
+    def stage(self, name):
+        """Add the duration of the with-block to a stage"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def mark_queued(self):
+        self.queued_at = time.monotonic()
+
+    def on_event(self, event_type, data):
+        """Track a websocket event for this job's prompt"""
+        now = time.monotonic()
+
+        if event_type == "execution_start" and self.queued_at is not None:
+            self.add("queue_wait", now - self.queued_at)
+            self.node_started = now
+        elif event_type == "executing":
+            if self.current_node is not None:
+                self.nodes[self.current_node] = self.nodes.get(self.current_node, 0) + now - self.node_started
+            self.current_node = data.get("node")
+            self.node_started = now
+
+    def mark_finished(self):
+        """Record queue-to-completion time once ComfyUI is done with the prompt"""
+        if self.queued_at is not None:
+            self.stages["prompt"] = time.monotonic() - self.queued_at
+        if self.nodes:
+            self.stages["execution"] = sum(self.nodes.values())
+
+    def as_dict(self):
+        """Timings in milliseconds"""
+        return {
+            "total_ms": round((time.monotonic() - self.started) * 1000, 1),
+            "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            "nodes_ms": {node: round(seconds * 1000, 1) for node, seconds in self.nodes.items()}
+        }
+
+
+class ComfyUIClient:
+    """
+    Keep-alive HTTP client for the ComfyUI API
+
+    All handler traffic goes through one pooled session so calls reuse
+    connections, and every call has a connect/read timeout so a hung server
+    can't block a job forever.
+    """
+
+    def __init__(self, base_url=COMFYUI_URL, connect_timeout=COMFYUI_CONNECT_TIMEOUT,
+                 read_timeout=COMFYUI_READ_TIMEOUT, pool_size=None):
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = "ws" + self.base_url[len("http"):] + "/ws"
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Concurrent jobs each hold a connection while waiting on ComfyUI
+        pool_size = pool_size or max(4, MAX_CONCURRENCY * 2)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """Send a request to ComfyUI with the client's default timeouts"""
+        return self.session.request(
+            method,
+            f"{self.base_url}{path}",
+            timeout=timeout or self.timeout,
+            **kwargs
         )
 
-        # Wait for server to be ready
-        max_retries = 30
-        for i in range(max_retries):
-            try:
-                response = requests.get("http://localhost:8188/history")
-                if response.status_code == 200:
-                    print("ComfyUI server is ready!")
-                    return True
-            except requests.exceptions.ConnectionError:
-                time.sleep(1)
-                print(f"Waiting for ComfyUI server... ({i+1}/{max_retries})")
+    def is_ready(self):
+        """True once ComfyUI answers API calls"""
+        try:
+            response = self.request("GET", "/system_stats", timeout=(1, 2))
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
 
-        print("Failed to start ComfyUI server")
-        return False
+    def queue_prompt(self, workflow, client_id=None):
+        """POST /prompt and return ComfyUI's response (prompt_id, number)"""
+        payload = {
+            "prompt": workflow
+        }
 
-    return True
+        # Execution events are only sent to the websocket registered with this id
+        if client_id:
+            payload["client_id"] = client_id
 
+        response = self.request("POST", "/prompt", json=payload)
 
-def queue_prompt(workflow):
-    """Queue a prompt/workflow in ComfyUI"""
-    url = "http://localhost:8188/prompt"
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise Exception(f"Failed to queue prompt: {response.text}")
 
-    payload = {
-        "prompt": workflow
-    }
+    def get_history(self, prompt_id):
+        """Return the history entry for a prompt, or None if it has not finished"""
+        response = self.request("GET", f"/history/{prompt_id}")
+        response.raise_for_status()
+        return response.json().get(prompt_id)
 
-    response = requests.post(url, json=payload)
+    def view(self, filename, subfolder="", folder_type="output"):
+        """Fetch the bytes of a file ComfyUI saved"""
+        response = self.request("GET", "/view", params={
+            "filename": filename,
+            "subfolder": subfolder,
+            "type": folder_type
+        })
+        response.raise_for_status()
+        return response.content
 
-    if response.status_code == 200:
+    def get_queue(self):
+        """Return the running and pending prompts"""
+        response = self.request("GET", "/queue")
+        response.raise_for_status()
         return response.json()
-    else:
-        raise Exception(f"Failed to queue prompt: {response.text}")
 
+    def interrupt(self):
+        """Interrupt the currently executing prompt"""
+        response = self.request("POST", "/interrupt")
+        response.raise_for_status()
 
-def wait_for_completion(prompt_id):
-    """Wait for a prompt to complete and return output files"""
-    max_wait = 300  # 5 minutes max
+    def free(self, unload_models=False, free_memory=False):
+        """Ask ComfyUI to unload models and/or release cached memory"""
+        response = self.request("POST", "/free", json={
+            "unload_models": unload_models,
+            "free_memory": free_memory
+        })
+        response.raise_for_status()
+
+    def system_stats(self):
+        """Return device and memory stats"""
+        response = self.request("GET", "/system_stats")
+        response.raise_for_status()
+        return response.json()
+
+    def object_info(self):
+        """Return the definitions of every installed node type"""
+        response = self.request("GET", "/object_info")
+        response.raise_for_status()
+        return response.json()
+
+    def open_websocket(self, client_id):
+        """Subscribe to ComfyUI's event stream, or return None to fall back to polling"""
+        if websocket is None:
+            return None
+
+        try:
+            ws = websocket.WebSocket()
+            ws.connect(f"{self.ws_url}?clientId={client_id}", timeout=self.timeout[0])
+            return ws
+        except Exception as e:
+            print(f"Websocket unavailable, falling back to /history polling: {e}")
+            return None
+
+
+comfyui = ComfyUIClient()
+residency = ResidencyManager(comfyui, get_model_size, enabled=RESIDENCY_MANAGER)
+validator = WorkflowValidator(COMFYUI_INPUT)
+
+
+def start_comfyui_server():
+    """Start ComfyUI server in background"""
+    # Concurrent jobs must not race to spawn a second server
+    with comfyui_start_lock:
+        return launch_comfyui_server()
+
+
+def launch_comfyui_server():
+    """Spawn ComfyUI and wait until it answers, unless it is already running"""
+    global comfyui_process, comfyui_external
+
+    if comfyui_process is not None and comfyui_process.poll() is None:
+        return True
+
+    # A server we didn't spawn (e.g. scripts/fake_comfyui.py) is used as-is
+    if comfyui_external or (comfyui_process is None and comfyui.is_ready()):
+        comfyui_external = True
+        return True
+
+    print("Starting ComfyUI server...")
+    print(f"Models path: {MODELS_PATH}")
+
+    # Point ComfyUI to the network storage models location
+    comfyui_process = subprocess.Popen(
+        [COMFYUI_PYTHON, "main.py",
+         "--listen", "0.0.0.0",
+         "--port", "8188",
+         "--input-directory", COMFYUI_INPUT,
+         "--output-directory", COMFYUI_OUTPUT,
+         # Local disk model tier first, then the network storage models
+         "--extra-model-paths-config", *get_model_paths_configs()],
+        cwd=COMFYUI_PATH,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    for stream, name in ((comfyui_process.stdout, "stdout"), (comfyui_process.stderr, "stderr")):
+        threading.Thread(
+            target=pump_comfyui_output,
+            args=(stream, name),
+            name=f"comfyui-{name}",
+            daemon=True
+        ).start()
+
+    # Wait for server to be ready, backing off from 100ms up to 1s
     start_time = time.time()
+    delay = 0.1
+    while time.time() - start_time < COMFYUI_START_TIMEOUT:
+        if comfyui_process.poll() is not None:
+            print(f"ComfyUI exited during startup (code {comfyui_process.returncode})")
+            break
+
+        if comfyui.is_ready():
+            print(f"ComfyUI server is ready! ({time.time() - start_time:.1f}s)")
+            return True
+
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+
+    print("Failed to start ComfyUI server")
+    if comfyui_process.poll() is None:
+        comfyui_process.terminate()
+    comfyui_process = None
+    return False
+
+
+def load_workflows(workflows_dir):
+    """Load the API-format workflows in a directory"""
+    workflows = []
+
+    if not os.path.isdir(workflows_dir):
+        return workflows
+
+    for filename in sorted(os.listdir(workflows_dir)):
+        if not filename.endswith(".json"):
+            continue
 
-    while time.time() - start_time < max_wait:
         try:
-            response = requests.get(f"http://localhost:8188/history/{prompt_id}")
-            history = response.json()
-
-            if prompt_id in history:
-                prompt_history = history[prompt_id]
-
-                print(f"History for prompt {prompt_id}: {json.dumps(prompt_history, indent=2)}")
-
-                # Check for errors
-                if "status" in prompt_history and prompt_history["status"].get("status_str") == "error":
-                    error_msg = prompt_history["status"].get("messages", [])
-                    raise Exception(f"ComfyUI workflow error: {error_msg}")
-
-                # Check if completed
-                if "outputs" in prompt_history:
-                    outputs = prompt_history["outputs"]
-                    output_files = []
-
-                    # Extract output files
-                    print(f"DEBUG: Processing outputs from {len(outputs)} nodes")
-                    for node_id, node_output in outputs.items():
-                        print(f"DEBUG: Node {node_id} output: {node_output.keys()}")
-                        if "images" in node_output:
-                            print(f"DEBUG: Node {node_id} has {len(node_output['images'])} images")
-                            for image in node_output["images"]:
-                                filename = image["filename"]
-                                output_files.append(filename)
-                                print(f"DEBUG: Added image: {filename}")
-
-                    print(f"DEBUG: Total output files collected: {len(output_files)}")
-                    return output_files
+            with open(os.path.join(workflows_dir, filename)) as f:
+                workflow = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Skipping unreadable workflow {filename}: {e}")
+            continue
+
+        # UI-format workflows have a "nodes" list instead of node ids
+        if not isinstance(workflow, dict) or "nodes" in workflow:
+            continue
+
+        workflows.append(workflow)
+
+    return workflows
+
+
+def find_workflow_checkpoints(workflows_dir):
+    """Collect checkpoint names used by API-format workflows in a directory"""
+    checkpoints = []
+
+    for workflow in load_workflows(workflows_dir):
+        for model_type, name in find_workflow_models(workflow):
+            if model_type == "checkpoints" and name not in checkpoints:
+                checkpoints.append(name)
+
+    return checkpoints
+
+
+def get_readahead_models():
+    """Resolve which model files to page in at boot"""
+    if READAHEAD_MODELS is None:
+        required = []
+        for workflow in load_workflows(WORKFLOWS_DIR):
+            for model in find_workflow_models(workflow):
+                if model not in required:
+                    required.append(model)
+        return required
+
+    if READAHEAD_MODELS.strip().lower() == "none":
+        return []
+
+    # "type/name" entries, e.g. checkpoints/sd_xl_base_1.0.safetensors
+    return [tuple(entry.strip().split("/", 1)) for entry in READAHEAD_MODELS.split(",") if "/" in entry]
+
+
+def build_warmup_workflow(ckpt_name):
+    """Minimal 1-step graph that loads a checkpoint's UNet, CLIP and VAE"""
+    return {
+        "1": {
+            "class_type": "CheckpointLoaderSimple",
+            "inputs": {"ckpt_name": ckpt_name}
+        },
+        "2": {
+            "class_type": "CLIPTextEncode",
+            "inputs": {"text": "", "clip": ["1", 1]}
+        },
+        "3": {
+            "class_type": "EmptyLatentImage",
+            "inputs": {"width": 64, "height": 64, "batch_size": 1}
+        },
+        "4": {
+            "class_type": "KSampler",
+            "inputs": {
+                "model": ["1", 0],
+                "positive": ["2", 0],
+                "negative": ["2", 0],
+                "latent_image": ["3", 0],
+                "seed": 0,
+                "steps": 1,
+                "cfg": 1.0,
+                "sampler_name": "euler",
+                "scheduler": "normal",
+                "denoise": 1.0
+            }
+        },
+        "5": {
+            "class_type": "VAEDecode",
+            "inputs": {"samples": ["4", 0], "vae": ["1", 2]}
+        },
+        "6": {
+            "class_type": "PreviewImage",
+            "inputs": {"images": ["5", 0]}
+        }
+    }
+
+
+def get_warmup_checkpoints():
+    """Resolve which checkpoints to preload at boot"""
+    if WARMUP_CHECKPOINTS is None:
+        return find_workflow_checkpoints(WORKFLOWS_DIR)
+
+    if WARMUP_CHECKPOINTS.strip().lower() == "none":
+        return []
+
+    return [c.strip() for c in WARMUP_CHECKPOINTS.split(",") if c.strip()]
+
+
+def warmup_models():
+    """Run a 1-step prompt per checkpoint so weights are resident before real traffic"""
+    for ckpt in get_warmup_checkpoints():
+        if not find_model_file("checkpoints", ckpt):
+            print(f"Skipping warm-up for missing checkpoint: {ckpt}")
+            continue
+
+        print(f"Warming up checkpoint: {ckpt}")
+        start_time = time.time()
+        client_id = uuid.uuid4().hex
+        ws = comfyui.open_websocket(client_id)
 
+        try:
+            result = comfyui.queue_prompt(build_warmup_workflow(ckpt), client_id)
+            wait_for_completion(result["prompt_id"], ws)
+            print(f"Warmed up {ckpt} in {time.time() - start_time:.1f}s")
+            residency.mark_used([("checkpoints", ckpt)])
         except Exception as e:
+            if ws is not None:
+                ws.close()
+            print(f"Warm-up failed for {ckpt}: {e}")
+
+
+def load_node_types():
+    """Teach the validator which node types ComfyUI has loaded, once it's up"""
+    if validator.node_types is not None:
+        return
+
+    try:
+        validator.set_node_types(comfyui.object_info().keys())
+    except Exception as e:
+        print(f"Could not load node types from ComfyUI: {e}")
+
+
+def init_worker():
+    """Start ComfyUI and preload models before the worker accepts jobs"""
+    start_janitor(COMFYUI_OUTPUT, COMFYUI_INPUT)
+
+    # Page model files in while ComfyUI is still starting up
+    start_readahead(get_readahead_models())
+    validator.build()
+
+    if not start_comfyui_server():
+        # Leave it to the first job to retry and report the failure
+        return
+
+    load_node_types()
+    warmup_models()
+
+
+def get_node_output_files(node_output):
+    """Extract output file paths, relative to COMFYUI_OUTPUT, from one node's output"""
+    output_files = []
+
+    for image in node_output.get("images", []):
+        # Previews go to ComfyUI's temp dir and are not returned
+        if image.get("type", "output") != "output":
+            continue
+        output_files.append(os.path.join(image.get("subfolder", ""), image["filename"]))
+
+    return output_files
+
+
+def wait_for_events(ws, prompt_id, deadline, seen_nodes, timer=None):
+    """
+    Follow the websocket until ComfyUI reports the prompt finished
+
+    Yields (node_id, output_files) as each output node is executed and records
+    the node in seen_nodes. Execution events are passed to timer when given.
+    Returns False if the stream drops so the caller can fall back to polling.
+    """
+    ws.settimeout(WS_RECV_TIMEOUT)
+
+    while time.time() < deadline:
+        try:
+            message = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            check_comfyui_alive()
+            # The prompt may have finished before we subscribed
+            if comfyui.get_history(prompt_id) is not None:
+                return True
+            continue
+        except (websocket.WebSocketException, OSError) as e:
+            print(f"Websocket dropped, falling back to /history polling: {e}")
+            return False
+
+        # Binary frames are sampler previews
+        if not isinstance(message, str):
+            continue
+
+        event = json.loads(message)
+        data = event.get("data", {})
+        if data.get("prompt_id") != prompt_id:
+            continue
+
+        event_type = event.get("type")
+        if timer is not None:
+            timer.on_event(event_type, data)
+
+        if event_type == "executed":
+            output_files = get_node_output_files(data.get("output") or {})
+            if output_files:
+                seen_nodes.add(data.get("node"))
+                yield data.get("node"), output_files
+            continue
+
+        # "executing" with node None is sent after the history entry is written;
+        # errors and interrupts are reported before it, so stop on those too
+        if event_type == "executing" and data.get("node") is None:
+            return True
+        if event_type in ("execution_error", "execution_interrupted"):
+            return True
+
+    raise Exception("Timeout waiting for prompt completion")
+
+
+def poll_history(prompt_id, deadline, interval):
+    """Poll /history until the prompt has an entry"""
+    while time.time() < deadline:
+        check_comfyui_alive()
+        try:
+            prompt_history = comfyui.get_history(prompt_id)
+            if prompt_history is not None:
+                return prompt_history
+        except (requests.exceptions.RequestException, ValueError) as e:
             print(f"Error checking completion: {e}")
 
-        time.sleep(2)
+        time.sleep(interval)
 
     raise Exception("Timeout waiting for prompt completion")
 
 
-def get_output_images(filenames, return_base64=True):
-    """Get output images as base64 or file paths"""
-    results = []
+def iter_prompt_outputs(prompt_id, ws=None, timer=None):
+    """
+    Yield (node_id, output_files) for each output node as soon as it finishes
+
+    Nodes the websocket did not report (cached nodes, polling fallback) are
+    yielded from the final history entry.
+    """
+    deadline = time.time() + PROMPT_TIMEOUT
+    interval = POLL_INTERVAL
+    seen_nodes = set()
+
+    if ws is not None:
+        try:
+            if (yield from wait_for_events(ws, prompt_id, deadline, seen_nodes, timer)):
+                # Only a short re-check is needed once the events say it's done
+                interval = 0.05
+        finally:
+            ws.close()
+
+    prompt_history = poll_history(prompt_id, deadline, interval)
+    if timer is not None:
+        timer.mark_finished()
+
+    status = prompt_history.get("status", {})
+    if status.get("status_str") == "error":
+        raise Exception(f"ComfyUI workflow error: {status.get('messages', [])}")
+
+    for node_id, node_output in prompt_history.get("outputs", {}).items():
+        if node_id in seen_nodes:
+            continue
+        output_files = get_node_output_files(node_output)
+        if output_files:
+            yield node_id, output_files
+
+
+def wait_for_completion(prompt_id, ws=None):
+    """Wait for a prompt to complete and return output files"""
+    output_files = []
+
+    for node_id, node_files in iter_prompt_outputs(prompt_id, ws):
+        output_files.extend(node_files)
+
+    return output_files
+
+
+def parse_output_format(option):
+    """
+    Normalize the output_format input into encoder settings
+
+    Accepts a format name ("raw", "png", "webp", "jpeg") or a dict such as
+    {"format": "jpeg", "quality": 90}, {"format": "webp", "lossless": true}
+    or {"format": "png", "compress_level": 9}.
+    """
+    if option is None:
+        return {"format": "raw"}
+
+    settings = {"format": option} if isinstance(option, str) else dict(option)
+    output_format = str(settings.get("format", "raw")).lower()
+    if output_format == "jpg":
+        output_format = "jpeg"
+
+    if output_format not in OUTPUT_EXTENSIONS:
+        raise Exception(f"Unsupported output_format: {output_format}")
+    if output_format != "raw" and Image is None:
+        raise Exception("Pillow is required to re-encode outputs")
+
+    settings["format"] = output_format
+    return settings
+
+
+def encode_image(image_bytes, settings):
+    """Re-encode image bytes according to output_format settings"""
+    output_format = settings["format"]
+    if output_format == "raw":
+        return image_bytes
+
+    image = Image.open(BytesIO(image_bytes))
+    buffer = BytesIO()
+
+    if output_format == "webp":
+        lossless = settings.get("lossless", True)
+        image.save(
+            buffer, "WEBP",
+            lossless=lossless,
+            quality=settings.get("quality", 80 if lossless else 90),
+            method=settings.get("method", 4)
+        )
+    elif output_format == "jpeg":
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(buffer, "JPEG", quality=settings.get("quality", 90), optimize=True)
+    else:
+        image.save(
+            buffer, "PNG",
+            optimize=settings.get("optimize", False),
+            compress_level=settings.get("compress_level", 6)
+        )
+
+    return buffer.getvalue()
+
+
+def read_output_file(filename):
+    """Read an output file from disk or through ComfyUI's /view endpoint"""
+    # Cached results are absolute paths on the volume, never served by ComfyUI
+    if FETCH_OUTPUTS_VIA_VIEW and not os.path.isabs(filename):
+        subfolder, name = os.path.split(filename)
+        return comfyui.view(name, subfolder)
+
+    with open(os.path.join(COMFYUI_OUTPUT, filename), "rb") as f:
+        return f.read()
+
+
+def output_name(filename, settings):
+    """An output's filename with the extension of the requested format"""
+    name = os.path.basename(filename)
+    extension = OUTPUT_EXTENSIONS[settings["format"]]
+    if extension:
+        name = os.path.splitext(name)[0] + extension
+    return name
+
+
+def process_output(filename, return_base64, settings, s3_config=None):
+    """
+    Encode one output file and start its S3 upload
+
+    The file is read and re-encoded once, and those bytes are both returned
+    and uploaded, so S3 objects match output_format; raw outputs on disk are
+    uploaded from the file. Returns (image entry or None, upload future or None).
+    """
+    filepath = os.path.join(COMFYUI_OUTPUT, filename)
+    on_disk = os.path.exists(filepath)
+    if not on_disk and not FETCH_OUTPUTS_VIA_VIEW:
+        return None, None
+
+    image_bytes = None
+    if return_base64 or (s3_config and (settings["format"] != "raw" or not on_disk)):
+        image_bytes = encode_image(read_output_file(filename), settings)
+    name = output_name(filename, settings)
+
+    upload = None
+    if s3_config:
+        upload = submit_s3_upload(
+            filepath if image_bytes is None else os.path.join(os.path.dirname(filepath), name),
+            s3_config["bucket"],
+            s3_config.get("prefix", ""),
+            s3_config.get("content_addressed", False),
+            data=image_bytes
+        )
+
+    if return_base64:
+        image = {"filename": name, "data": base64.b64encode(image_bytes).decode('utf-8')}
+    elif on_disk:
+        image = {"filename": os.path.basename(filename), "path": filepath}
+    else:
+        image = None
+
+    return image, upload
+
+
+def submit_output_images(filenames, return_base64=True, output_format=None, s3_config=None):
+    """Queue each output file's encode (and upload) on the encode pool; returns the futures"""
+    settings = output_format or parse_output_format(None)
+    return [
+        encode_pool.submit(process_output, filename, return_base64, settings, s3_config)
+        for filename in filenames
+    ]
 
-    for filename in filenames:
-        filepath = os.path.join(COMFYUI_OUTPUT, filename)
 
-        if os.path.exists(filepath):
-            if return_base64:
-                with open(filepath, "rb") as f:
-                    image_data = base64.b64encode(f.read()).decode('utf-8')
-                    results.append({
-                        "filename": filename,
-                        "data": image_data
-                    })
+def collect_output_images(futures):
+    """Wait for submitted encodes in order; returns (image entries, S3 upload futures)"""
+    results = [future.result() for future in futures]
+    return [image for image, _ in results if image], [upload for _, upload in results if upload]
+
+
+def get_job_namespace(job):
+    """Filesystem-safe folder name that isolates a job's inputs and outputs"""
+    job_id = str(job.get("id") or uuid.uuid4().hex)
+    return re.sub(r"[^A-Za-z0-9_-]", "_", job_id)
+
+
+def normalize_reference_images(reference_images):
+    """
+    Turn the reference_images input into a list of {filename, sha256, data}
+
+    Accepts {filename: base64}, {filename: {"sha256": ..., "data": ...}} or a
+    list of {"filename": ..., "sha256": ..., "data": ...}. "data" may be left
+    out when the worker is expected to have the hash cached.
+    """
+    if isinstance(reference_images, dict):
+        references = []
+        for filename, value in reference_images.items():
+            if isinstance(value, dict):
+                references.append({"filename": filename, **value})
             else:
-                results.append({
-                    "filename": filename,
-                    "path": filepath
-                })
+                references.append({"filename": filename, "data": value})
+    else:
+        references = list(reference_images)
 
-    return results
+    for reference in references:
+        if not reference.get("filename"):
+            raise Exception("Reference image is missing a filename")
+        if reference.get("data") is None and not reference.get("sha256"):
+            raise Exception(f"Reference image {reference['filename']} needs data or sha256")
 
+    return references
 
-def handler(event):
+
+def save_reference_images(references, input_dir):
     """
-    Main handler function for RunPod serverless
+    Place reference images in the job's input folder through the content cache
+
+    Records each image's digest in reference["sha256"] and returns the
+    hash-only references whose bytes are not cached, so the client can resend
+    them with data.
+    """
+    os.makedirs(input_dir, exist_ok=True)
+    missing = []
+
+    for reference in references:
+        filename = os.path.basename(reference["filename"])
+        filepath = os.path.join(input_dir, filename)
+        digest = reference.get("sha256")
+
+        if reference.get("data") is None:
+            if get_cached_input(digest) is None:
+                missing.append({"filename": filename, "sha256": digest})
+                continue
+            link_cached_input(digest, filepath)
+            print(f"  Linked from cache: {filepath}")
+            continue
+
+        image_bytes = base64.b64decode(reference["data"])
+        actual_digest = sha256_bytes(image_bytes)
+        if digest and actual_digest != digest:
+            raise Exception(f"sha256 mismatch for reference image {filename}")
+        reference["sha256"] = actual_digest
+
+        try:
+            cached = store_cached_input(image_bytes, actual_digest)
+        except OSError as e:
+            print(f"  Input cache unavailable: {e}")
+            cached = None
+
+        if cached:
+            link_cached_input(actual_digest, filepath)
+        else:
+            with open(filepath, "wb") as f:
+                f.write(image_bytes)
+        print(f"  Saved: {filepath}")
+
+    return missing
+
+
+def namespace_workflow(workflow, namespace, reference_names):
+    """
+    Point the workflow at the job's own input/output subfolders
+
+    LoadImage nodes that use an uploaded reference image read it from
+    input/<namespace>/, and every filename_prefix is moved under
+    output/<namespace>/ so concurrent jobs never see each other's files.
+    """
+    workflow = json.loads(json.dumps(workflow))
+
+    for node_data in workflow.values():
+        if not isinstance(node_data, dict):
+            continue
+
+        inputs = node_data.get("inputs", {})
+
+        if node_data.get("class_type") in ("LoadImage", "LoadImageMask"):
+            image = inputs.get("image")
+            if isinstance(image, str) and image in reference_names:
+                inputs["image"] = f"{namespace}/{image}"
+
+        prefix = inputs.get("filename_prefix")
+        if isinstance(prefix, str):
+            inputs["filename_prefix"] = f"{namespace}/{prefix}"
+
+    return workflow
+
+
+def model_identity(model_type, name):
+    """
+    Cheap identity for a model file - hashing multi-GB weights per job is too slow
+
+    The manifest's sha256 when it has one, otherwise the size and mtime of the
+    baked-in or volume copy, so every worker derives the same result cache key
+    whether or not the model has been promoted to its local tier.
+    """
+    entry = get_manifest().get(name)
+    if entry and entry.get("sha256") and entry.get("type", model_type) == model_type:
+        return f"{name}@sha256:{entry['sha256']}"
+
+    try:
+        stat = os.stat(find_source_model_file(model_type, name) or "")
+    except OSError:
+        return f"{name}@missing"
+    return f"{name}@{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def workflow_cache_key(workflow, references):
+    """
+    Hash a workflow into a result cache key
+
+    The graph is canonicalized first: UI metadata is dropped, LoadImage inputs
+    are replaced by the image's content hash and model names by their file
+    identity, so identical jobs map to the same key regardless of upload names.
+    """
+    reference_hashes = {os.path.basename(r["filename"]): r["sha256"] for r in references}
+    canonical = {}
+
+    for node_id, node_data in workflow.items():
+        if not isinstance(node_data, dict):
+            continue
+
+        class_type = node_data.get("class_type")
+        inputs = dict(node_data.get("inputs", {}))
+
+        if class_type in ("LoadImage", "LoadImageMask") and isinstance(inputs.get("image"), str):
+            image = inputs["image"]
+            if image in reference_hashes:
+                inputs["image"] = f"sha256:{reference_hashes[image]}"
+            else:
+                try:
+                    inputs["image"] = f"sha256:{file_sha256(os.path.join(COMFYUI_INPUT, image))}"
+                except OSError:
+                    inputs["image"] = f"missing:{image}"
+
+        for input_name, model_type in MODEL_LOADER_INPUTS.get(class_type, {}).items():
+            if isinstance(inputs.get(input_name), str):
+                inputs[input_name] = model_identity(model_type, inputs[input_name])
+
+        canonical[node_id] = {"class_type": class_type, "inputs": inputs}
+
+    payload = json.dumps(
+        {"version": RESULT_CACHE_VERSION, "workflow": canonical},
+        sort_keys=True,
+        separators=(",", ":")
+    )
+    return sha256_bytes(payload.encode("utf-8"))
+
+
+def store_result(cache_key, prompt_id, node_outputs, namespace, keep_outputs):
+    """Copy a job's outputs into the result cache, then remove its output folder"""
+    try:
+        store_cached_result(cache_key, prompt_id, node_outputs, COMFYUI_OUTPUT)
+        print(f"Stored result {cache_key}")
+    except OSError as e:
+        print(f"Failed to store result {cache_key}: {e}")
+    finally:
+        if not keep_outputs:
+            schedule_removal(os.path.join(COMFYUI_OUTPUT, namespace))
+        release(namespace)
+
+
+def submit_prompt(workflow):
+    """Queue a workflow and return (prompt_id, websocket or None)"""
+    # Subscribe before queueing so no execution events are missed
+    client_id = uuid.uuid4().hex
+    ws = comfyui.open_websocket(client_id)
+
+    try:
+        result = comfyui.queue_prompt(workflow, client_id)
+        prompt_id = result.get("prompt_id")
+        if not prompt_id:
+            raise Exception("Failed to get prompt_id from ComfyUI")
+    except Exception:
+        if ws is not None:
+            ws.close()
+        raise
+
+    return prompt_id, ws
+
+
+def collect_s3_uploads(uploads):
+    """
+    Wait for upload futures and build the response fields
+
+    Content-addressed uploads return dicts and also fill s3_objects with each
+    object's key and hash; plain uploads return just the URL.
+    """
+    results = [upload.result() for upload in uploads]
+    objects = [result for result in results if isinstance(result, dict)]
+
+    fields = {"s3_urls": [result["url"] if isinstance(result, dict) else result for result in results]}
+    if objects:
+        fields["s3_objects"] = [
+            {"url": obj["url"], "key": obj["key"], "sha256": obj["sha256"]}
+            for obj in objects
+        ]
+
+    return fields
+
+
+def remove_job_files(namespace, keep_outputs=False):
+    """
+    Hand the job's input folder and, once returned, its output folder to the
+    janitor; kept outputs are left to its age and quota passes
+    """
+    schedule_removal(os.path.join(COMFYUI_INPUT, namespace))
+
+    if not keep_outputs:
+        schedule_removal(os.path.join(COMFYUI_OUTPUT, namespace))
+
+    release(namespace)
+
+
+def execute_job(job, stream=False):
+    """
+    Run one job against the shared ComfyUI server
+
+    Generator: when streaming, yields a partial result per finished output
+    node and then a final summary; otherwise yields only the full response.
 
     Expected input format:
     {
@@ -168,156 +1052,271 @@ def handler(event):
             "checkpoints": ["model.safetensors"],
             "loras": ["lora.safetensors"]
         },
+        "reference_images": {   # Optional: images for LoadImage nodes
+            "grass.png": "...",                     # base64 bytes
+            "stone.png": {"sha256": "..."}          # bytes already cached on the volume
+        },
         "return_base64": true,  # Return images as base64 (default: true)
+        "output_format": "webp",  # Optional: raw (default), png, webp, jpeg or a settings dict
         "s3_upload": {          # Optional: upload to S3
             "bucket": "my-bucket",
-            "prefix": "outputs/"
-        }
+            "prefix": "outputs/",
+            "content_addressed": true  # Optional: key by SHA-256, skip existing objects
+        },
+        "cache": "bypass"       # Optional: skip the result cache
     }
     """
+    namespace = get_job_namespace(job)
+    keep_outputs = False
+    timer = JobTimer()
+    protect(namespace)
+
     try:
-        input_data = event.get('input', {})
+        input_data = job.get('input', {})
 
-        # Save reference images BEFORE starting ComfyUI so it can see them
-        if "reference_images" in input_data:
+        # Reference images go into a per-job subfolder so concurrent jobs can't overwrite them
+        references = normalize_reference_images(input_data.get("reference_images", {}))
+        if references:
             print("Saving reference images to input folder...")
-            reference_images = input_data["reference_images"]
-            for filename, image_base64 in reference_images.items():
-                filepath = os.path.join(COMFYUI_INPUT, filename)
-                with open(filepath, "wb") as f:
-                    f.write(base64.b64decode(image_base64))
-                print(f"  Saved: {filepath}")
-
-        # Start ComfyUI server if not running
-        if not start_comfyui_server():
-            return {
-                "error": "Failed to start ComfyUI server"
-            }
-
-        # Download models if specified
-        if "models" in input_data:
-            print("Downloading models...")
-            download_models(input_data["models"])
+            with timer.stage("reference_images"):
+                missing = save_reference_images(references, os.path.join(COMFYUI_INPUT, namespace))
+            if missing:
+                yield {
+                    "error": "Reference images not cached, resend them with data",
+                    "need_bytes": missing,
+                    "timings": timer.as_dict()
+                }
+                return
 
         # Get workflow
         workflow = input_data.get("workflow")
         if not workflow:
-            return {
-                "error": "No workflow provided in input"
+            yield {
+                "error": "No workflow provided in input",
+                "timings": timer.as_dict()
             }
+            return
 
-        print("Queueing workflow...")
-        print(f"DEBUG: Workflow has {len(workflow)} nodes")
+        # Reject a bad output_format before the prompt occupies the GPU
+        return_base64 = input_data.get("return_base64", True)
+        output_format = parse_output_format(input_data.get("output_format"))
 
-        # Debug: List model directories
-        print("\nDEBUG: Listing model directories:")
-        checkpoints_dir = "/runpod-volume/comfyui/models/checkpoints"
-        controlnet_dir = "/runpod-volume/comfyui/models/controlnet"
+        # Download models if specified
+        if "models" in input_data:
+            print("Downloading models...")
+            with timer.stage("model_download"):
+                download_models(input_data["models"], model_dirs)
 
-        if os.path.exists(checkpoints_dir):
-            checkpoints = os.listdir(checkpoints_dir)
-            print(f"  Checkpoints dir: {checkpoints}")
-        else:
-            print(f"  Checkpoints dir DOES NOT EXIST: {checkpoints_dir}")
+        # Fetch models the workflow's loader nodes need from the manifest
+        with timer.stage("model_prefetch"):
+            unknown_models = prefetch_models(workflow)
+        for model_type, name in unknown_models:
+            print(f"Model not on disk or in manifest: {model_type}/{name}")
 
-        if os.path.exists(controlnet_dir):
-            controlnets = os.listdir(controlnet_dir)
-            print(f"  ControlNet dir: {controlnets}")
-        else:
-            print(f"  ControlNet dir DOES NOT EXIST: {controlnet_dir}")
+        # Identical resubmissions are answered from the result cache
+        cache_key = None
+        cached = None
+        if RESULT_CACHE_DIR and input_data.get("cache") != "bypass":
+            with timer.stage("cache_lookup"):
+                cache_key = workflow_cache_key(workflow, references)
+                cached = get_cached_result(cache_key)
 
-        if os.path.exists(COMFYUI_INPUT):
-            input_files = os.listdir(COMFYUI_INPUT)
-            print(f"  Input dir: {input_files}")
+        if cached:
+            print(f"Result cache hit: {cache_key}")
+            prompt_id = cached["prompt_id"]
+            node_outputs = [(output["node_id"], output["files"]) for output in cached["outputs"]]
         else:
-            print(f"  Input dir DOES NOT EXIST: {COMFYUI_INPUT}")
-
-        # Debug: Check for missing files
-        print("\nDEBUG: Checking workflow requirements:")
-        for node_id, node_data in workflow.items():
-            if node_data.get("class_type") == "CheckpointLoaderSimple":
-                ckpt = node_data["inputs"]["ckpt_name"]
-                ckpt_path = f"/runpod-volume/comfyui/models/checkpoints/{ckpt}"
-                if os.path.exists(ckpt_path):
-                    print(f"  ✓ Found checkpoint: {ckpt}")
-                else:
-                    print(f"  ✗ MISSING checkpoint: {ckpt} at {ckpt_path}")
-
-            elif node_data.get("class_type") == "ControlNetLoader":
-                cn = node_data["inputs"]["control_net_name"]
-                cn_path = f"/runpod-volume/comfyui/models/controlnet/{cn}"
-                if os.path.exists(cn_path):
-                    print(f"  ✓ Found ControlNet: {cn}")
-                else:
-                    print(f"  ✗ MISSING ControlNet: {cn} at {cn_path}")
-
-            elif node_data.get("class_type") == "LoadImage":
-                img = node_data["inputs"]["image"]
-                img_path = f"{COMFYUI_INPUT}/{img}"
-                if os.path.exists(img_path):
-                    print(f"  ✓ Found image: {img}")
-                else:
-                    print(f"  ✗ MISSING image: {img} at {img_path}")
-
-        result = queue_prompt(workflow)
-        prompt_id = result.get("prompt_id")
+            reference_names = {os.path.basename(reference["filename"]) for reference in references}
+            workflow = namespace_workflow(workflow, namespace, reference_names)
 
-        if not prompt_id:
-            return {
-                "error": "Failed to get prompt_id from ComfyUI"
-            }
+            # Fail fast on jobs that can't run instead of holding a queue slot
+            with timer.stage("validate"):
+                validation_errors = validator.validate(workflow)
+            if validation_errors:
+                yield {
+                    "error": "Workflow failed validation",
+                    "validation_errors": validation_errors,
+                    "timings": timer.as_dict()
+                }
+                return
 
-        print(f"Waiting for completion (prompt_id: {prompt_id})...")
-        output_files = wait_for_completion(prompt_id)
+            # Start ComfyUI server if not running
+            with timer.stage("server_start"):
+                started = start_comfyui_server()
+            if not started:
+                yield {
+                    "error": "Failed to start ComfyUI server",
+                    "comfyui_log": get_comfyui_log_tail(),
+                    "timings": timer.as_dict()
+                }
+                return
+            load_node_types()
 
-        print(f"Generated {len(output_files)} images")
-        print(f"Output files: {output_files}")
-        print(f"Output directory contents: {os.listdir(COMFYUI_OUTPUT) if os.path.exists(COMFYUI_OUTPUT) else 'DIR NOT FOUND'}")
+            print("Queueing workflow...")
 
-        # Get output images
-        return_base64 = input_data.get("return_base64", True)
-        images = get_output_images(output_files, return_base64)
-
-        # Upload to S3 if configured
-        s3_urls = []
-        if "s3_upload" in input_data:
-            print("Uploading to S3...")
-            s3_config = input_data["s3_upload"]
-            for image in images:
-                filepath = os.path.join(COMFYUI_OUTPUT, image["filename"])
-                s3_url = upload_to_s3(
-                    filepath,
-                    s3_config["bucket"],
-                    s3_config.get("prefix", "")
-                )
-                s3_urls.append(s3_url)
-
-        # Cleanup old outputs
-        cleanup_outputs(COMFYUI_OUTPUT)
+            # Unload other pipelines' models first if this job's won't fit
+            with timer.stage("residency"):
+                residency.prepare(find_workflow_models(workflow))
+
+            with timer.stage("queue_prompt"):
+                prompt_id, ws = submit_prompt(workflow)
+            timer.mark_queued()
+            print(f"Waiting for completion (prompt_id: {prompt_id})...")
+            node_outputs = iter_prompt_outputs(prompt_id, ws, timer)
+
+        s3_config = input_data.get("s3_upload")
+
+        images = []
+        s3_uploads = []
+        pending_encodes = []
+        output_count = 0
+        produced = []
+
+        for node_id, output_files in node_outputs:
+            print(f"Node {node_id} saved {len(output_files)} images: {output_files}")
+            output_count += len(output_files)
+            produced.append((node_id, output_files))
+
+            # Files encode in parallel, and upload as soon as they're encoded, while later nodes run
+            encodes = submit_output_images(output_files, return_base64, output_format, s3_config)
+
+            if stream:
+                with timer.stage("encode"):
+                    node_images, node_uploads = collect_output_images(encodes)
+                partial = {
+                    "status": "partial",
+                    "node_id": node_id,
+                    "images": node_images,
+                    "prompt_id": prompt_id
+                }
+                if node_uploads:
+                    with timer.stage("s3_upload"):
+                        partial.update(collect_s3_uploads(node_uploads))
+                yield partial
+            else:
+                pending_encodes.extend(encodes)
+
+        if pending_encodes:
+            # Only the encode time not hidden behind execution is counted
+            with timer.stage("encode"):
+                images, s3_uploads = collect_output_images(pending_encodes)
+
+        s3_results = {}
+        if s3_uploads:
+            # Only the upload time not hidden behind execution and encoding is counted
+            with timer.stage("s3_upload"):
+                s3_results = collect_s3_uploads(s3_uploads)
+
+        print(f"Generated {output_count} images")
+
+        # Note what's loaded now and copy this job's models to local disk for the next load
+        if not cached:
+            required_models = find_workflow_models(workflow)
+            residency.mark_used(required_models)
+            promote_models(required_models)
+
+        # Paths are only useful while the files stay on the worker
+        keep_outputs = not return_base64 and not s3_config
+
+        if cache_key and not cached and produced:
+            # Copying to the volume happens off the request path; the output
+            # folder is removed by the copy thread once it's done
+            protect(namespace)
+            threading.Thread(
+                target=store_result,
+                args=(cache_key, prompt_id, produced, namespace, keep_outputs),
+                name="store-result",
+                daemon=True
+            ).start()
+            keep_outputs = True
+
+        if stream:
+            # Images were already sent with the partial results
+            yield {
+                "status": "success",
+                "prompt_id": prompt_id,
+                "image_count": output_count,
+                "cached": bool(cached),
+                "timings": timer.as_dict()
+            }
+            return
 
         response = {
             "status": "success",
             "images": images,
-            "prompt_id": prompt_id
+            "prompt_id": prompt_id,
+            "cached": bool(cached),
+            "timings": timer.as_dict()
         }
 
-        if s3_urls:
-            response["s3_urls"] = s3_urls
+        response.update(s3_results)
 
-        return response
+        yield response
 
     except Exception as e:
         print(f"Error in handler: {str(e)}")
         import traceback
         traceback.print_exc()
 
-        return {
+        yield {
             "error": str(e),
-            "traceback": traceback.format_exc()
+            "traceback": traceback.format_exc(),
+            "comfyui_log": get_comfyui_log_tail(),
+            "timings": timer.as_dict()
         }
 
+    finally:
+        remove_job_files(namespace, keep_outputs)
+        # One structured line per job for log-based analysis
+        print(json.dumps({"event": "job_timings", "job_id": namespace, **timer.as_dict()}))
+
+
+def run_job(job):
+    """Run a job to completion and return its full response"""
+    response = None
+    for response in execute_job(job):
+        pass
+    return response
+
+
+async def handler(job):
+    """
+    Main handler function for RunPod serverless
+
+    Each job runs in its own thread so one job can decode, upload or wait on
+    the network while another is sampling on the GPU.
+    """
+    return await asyncio.to_thread(run_job, job)
+
+
+async def stream_handler(job):
+    """
+    Streaming handler for RunPod's /stream endpoint
+
+    Yields each output node's images as soon as ComfyUI saves them, so the
+    first tile arrives early and only one node's images are held at a time.
+    """
+    results = execute_job(job, stream=True)
+
+    while True:
+        result = await asyncio.to_thread(next, results, None)
+        if result is None:
+            break
+        yield result
+
+
+def concurrency_modifier(current_concurrency):
+    """Number of jobs this worker accepts at once"""
+    return MAX_CONCURRENCY
+
 
 if __name__ == "__main__":
     print(f"Starting RunPod Serverless Handler for ComfyUI - Version {HANDLER_VERSION}")
     print(f"Checking symlink: /comfyui/models -> {os.readlink('/comfyui/models') if os.path.islink('/comfyui/models') else 'NOT A SYMLINK'}")
-    runpod.serverless.start({"handler": handler})
+    init_worker()
+    runpod.serverless.start({
+        "handler": stream_handler if STREAM_OUTPUTS else handler,
+        "concurrency_modifier": concurrency_modifier,
+        # /run and /status still receive every streamed chunk as a list
+        "return_aggregate_stream": True
+    })
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Background cleanup of ComfyUI's input and output directories
+
+Jobs hand their finished folders to the janitor instead of deleting them
+inline, and a periodic pass keeps each directory under its age, byte and
+file-count limits. Nothing here runs on the request path.
+"""
+
+import os
+import time
+import queue
+import shutil
+import threading
+
+
+# Seconds between quota passes
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", "60"))
+
+# Limits for outputs kept on the worker (return_base64=false or a failed upload)
+OUTPUT_MAX_AGE = int(os.environ.get("OUTPUT_MAX_AGE", "3600"))
+OUTPUT_MAX_BYTES = int(os.environ.get("OUTPUT_MAX_BYTES", str(5 * 1024 ** 3)))
+OUTPUT_MAX_FILES = int(os.environ.get("OUTPUT_MAX_FILES", "10000"))
+
+# Limits for per-job reference image folders left behind by crashed jobs
+INPUT_MAX_BYTES = int(os.environ.get("INPUT_MAX_BYTES", str(2 * 1024 ** 3)))
+INPUT_MAX_FILES = int(os.environ.get("INPUT_MAX_FILES", "10000"))
+
+# Folders queued for deletion
+removal_queue = queue.Queue()
+
+# Job folder names in use -> number of holders; quota passes leave them alone
+active_jobs = {}
+active_jobs_lock = threading.Lock()
+
+janitor_thread = None
+janitor_lock = threading.Lock()
+
+
+def protect(namespace):
+    """Keep a job's folders out of quota passes until release() is called"""
+    with active_jobs_lock:
+        active_jobs[namespace] = active_jobs.get(namespace, 0) + 1
+
+
+def release(namespace):
+    """Drop one hold on a job's folders"""
+    with active_jobs_lock:
+        count = active_jobs.get(namespace, 0) - 1
+        if count > 0:
+            active_jobs[namespace] = count
+        else:
+            active_jobs.pop(namespace, None)
+
+
+def is_active(namespace):
+    """True while a job holds the folder"""
+    with active_jobs_lock:
+        return namespace in active_jobs
+
+
+def schedule_removal(path):
+    """Delete a file or folder in the background"""
+    removal_queue.put(path)
+
+
+def remove_path(path):
+    """Delete a file or folder, ignoring ones that are already gone"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def scan_files(directory, include_top_level=True):
+    """
+    Return (mtime, size, path, job folder) for every file under directory
+
+    Files in a top-level subfolder report that folder's name as the job
+    folder, so active jobs can be skipped. With include_top_level=False
+    only files inside subfolders are returned.
+    """
+    entries = []
+    pending = [(directory, None)]
+
+    while pending:
+        current, job_folder = pending.pop()
+        try:
+            iterator = os.scandir(current)
+        except FileNotFoundError:
+            continue
+
+        with iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append((entry.path, job_folder or entry.name))
+                        continue
+                    if job_folder is None and not include_top_level:
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path, job_folder))
+
+    return entries
+
+
+def remove_empty_dirs(directory):
+    """Remove subfolders of directory left empty by quota passes"""
+    for root, dirs, files in os.walk(directory, topdown=False):
+        if root == directory or files or dirs or is_active(os.path.relpath(root, directory).split(os.sep)[0]):
+            continue
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+
+
+def enforce_quota(directory, max_bytes, max_files, max_age=None, include_top_level=True):
+    """Delete expired files, then the oldest ones until the directory is within its limits"""
+    now = time.time()
+    entries = sorted(
+        entry for entry in scan_files(directory, include_top_level)
+        if entry[3] is None or not is_active(entry[3])
+    )
+    total_bytes = sum(size for _, size, _, _ in entries)
+    total_files = len(entries)
+    removed = 0
+
+    for mtime, size, path, job_folder in entries:
+        expired = max_age is not None and now - mtime > max_age
+        if not expired and total_bytes <= max_bytes and total_files <= max_files:
+            break
+        remove_path(path)
+        total_bytes -= size
+        total_files -= 1
+        removed += 1
+
+    if removed:
+        print(f"Janitor removed {removed} files from {directory}")
+        remove_empty_dirs(directory)
+
+
+def run_janitor(output_dir, input_dir):
+    """Delete queued folders as they arrive and run a quota pass every JANITOR_INTERVAL"""
+    next_pass = time.time()
+
+    while True:
+        timeout = next_pass - time.time()
+        if timeout > 0:
+            try:
+                remove_path(removal_queue.get(timeout=timeout))
+                continue
+            except queue.Empty:
+                pass
+
+        try:
+            enforce_quota(output_dir, OUTPUT_MAX_BYTES, OUTPUT_MAX_FILES, OUTPUT_MAX_AGE)
+            # Loose files in the input dir are user assets; only job folders are managed
+            enforce_quota(input_dir, INPUT_MAX_BYTES, INPUT_MAX_FILES, include_top_level=False)
+        except OSError as e:
+            print(f"Janitor pass failed: {e}")
+
+        next_pass = time.time() + JANITOR_INTERVAL
+
+
+def start_janitor(output_dir, input_dir):
+    """Start the janitor thread once per process"""
+    global janitor_thread
+
+    with janitor_lock:
+        if janitor_thread is None:
+            janitor_thread = threading.Thread(
+                target=run_janitor, args=(output_dir, input_dir), name="janitor", daemon=True
+            )
+            janitor_thread.start()
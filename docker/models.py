@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Model registry for the ComfyUI serverless handler
+
+Resolves model folders the same way ComfyUI does (from model_paths.yaml),
+fetches models a workflow needs from the manifest before it is queued, and
+keeps recently used models on local disk in front of the network volume.
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import download_file, download_from_s3, download_once
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# ComfyUI install, whose own models/ folder holds models baked into the image
+COMFYUI_PATH = os.environ.get("COMFYUI_PATH", "/comfyui")
+
+# ComfyUI's extra model paths config - the single source of truth for model folders
+MODEL_PATHS_CONFIG = os.environ.get("MODEL_PATHS_CONFIG", "/model_paths.yaml")
+DEFAULT_MODELS_PATH = "/runpod-volume/comfyui/models"
+DEFAULT_MODEL_TYPES = [
+    "checkpoints", "vae", "loras", "upscale_models", "embeddings", "controlnet", "clip_vision"
+]
+
+# Manifest of downloadable models: name -> {type, url or s3, size, sha256}
+MODEL_MANIFEST = os.environ.get("MODEL_MANIFEST", "/model_manifest.json")
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", "4"))
+
+# Local disk tier in front of the network volume - empty LOCAL_MODEL_DIR disables it
+LOCAL_MODEL_DIR = os.environ.get("LOCAL_MODEL_DIR", "/local-models")
+LOCAL_MODEL_MAX_BYTES = int(os.environ.get("LOCAL_MODEL_MAX_BYTES", str(20 * 1024 ** 3)))
+LOCAL_MODEL_RESERVE_BYTES = 2 * 1024 ** 3  # Free container disk left for outputs
+LOCAL_MODEL_PATHS_CONFIG = "/tmp/local_model_paths.yaml"
+
+# Boot-time readahead - stop before evicting more page cache than this share of RAM
+READAHEAD_MEMORY_FRACTION = float(os.environ.get("READAHEAD_MEMORY_FRACTION", "0.5"))
+READAHEAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Loader node inputs that name a model file, and the model type they resolve in
+MODEL_LOADER_INPUTS = {
+    "CheckpointLoaderSimple": {"ckpt_name": "checkpoints"},
+    "LoraLoader": {"lora_name": "loras"},
+    "LoraLoaderModelOnly": {"lora_name": "loras"},
+    "VAELoader": {"vae_name": "vae"},
+    "ControlNetLoader": {"control_net_name": "controlnet"},
+    "UpscaleModelLoader": {"model_name": "upscale_models"},
+    "CLIPVisionLoader": {"clip_name": "clip_vision"},
+}
+
+# Parsed manifest and the mtime it was read at
+manifest_cache = {"mtime": None, "models": {}}
+
+# Models waiting to be copied to the local tier
+promotion_queue = queue.Queue()
+promotions_pending = set()
+promotion_lock = threading.Lock()
+promotion_thread = None
+
+
+def load_model_dirs(config_path=MODEL_PATHS_CONFIG):
+    """Map each model type to its folder as configured in model_paths.yaml"""
+    model_dirs = {model_type: os.path.join(DEFAULT_MODELS_PATH, model_type) for model_type in DEFAULT_MODEL_TYPES}
+
+    if yaml is None or not os.path.exists(config_path):
+        return model_dirs
+
+    with open(config_path) as f:
+        config = yaml.safe_load(f) or {}
+
+    for section in config.values():
+        if not isinstance(section, dict):
+            continue
+
+        base_path = section.get("base_path", "")
+        for model_type, folders in section.items():
+            if model_type in ("base_path", "is_default") or not isinstance(folders, str):
+                continue
+            # ComfyUI allows several folders per type; downloads go to the first
+            folder = folders.strip().splitlines()[0].strip()
+            model_dirs[model_type] = os.path.join(base_path, folder)
+
+    return model_dirs
+
+
+model_dirs = load_model_dirs()
+
+
+def get_model_path(model_type, name):
+    """Where ComfyUI will look for a model of the given type"""
+    return os.path.join(model_dirs.get(model_type, os.path.join(DEFAULT_MODELS_PATH, model_type)), name)
+
+
+def get_model_search_dirs(model_type):
+    """
+    Every folder ComfyUI searches for a model type, in its lookup order
+
+    The local tier is registered with is_default, so it comes ahead of
+    ComfyUI's own models/ folder; the network volume config comes after.
+    """
+    search_dirs = [
+        os.path.join(COMFYUI_PATH, "models", model_type),
+        model_dirs.get(model_type, os.path.join(DEFAULT_MODELS_PATH, model_type))
+    ]
+    if LOCAL_MODEL_DIR:
+        search_dirs.insert(0, os.path.join(LOCAL_MODEL_DIR, model_type))
+    return search_dirs
+
+
+def find_model_file(model_type, name):
+    """The first copy of a model ComfyUI would find, or None if there is none"""
+    for folder in get_model_search_dirs(model_type):
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def find_source_model_file(model_type, name):
+    """
+    The baked-in or network volume copy of a model, or None
+
+    Skips the local tier, whose copies get a new mtime when they are
+    promoted and every time a job uses them.
+    """
+    for folder in get_model_search_dirs(model_type):
+        if LOCAL_MODEL_DIR and folder == os.path.join(LOCAL_MODEL_DIR, model_type):
+            continue
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def get_manifest():
+    """Return the model manifest, re-reading it when the file changes"""
+    try:
+        mtime = os.path.getmtime(MODEL_MANIFEST)
+    except OSError:
+        return {}
+
+    if manifest_cache["mtime"] != mtime:
+        with open(MODEL_MANIFEST) as f:
+            manifest_cache["models"] = json.load(f).get("models", {})
+        manifest_cache["mtime"] = mtime
+
+    return manifest_cache["models"]
+
+
+def find_workflow_models(workflow):
+    """Return the (model type, name) pairs a workflow's loader nodes reference"""
+    required = []
+
+    for node_data in workflow.values():
+        if not isinstance(node_data, dict):
+            continue
+
+        inputs = node_data.get("inputs", {})
+        for input_name, model_type in MODEL_LOADER_INPUTS.get(node_data.get("class_type"), {}).items():
+            name = inputs.get(input_name)
+            if isinstance(name, str) and (model_type, name) not in required:
+                required.append((model_type, name))
+
+    return required
+
+
+def fetch_model(model_type, name, entry):
+    """Download one manifest entry into the model folder ComfyUI reads"""
+    destination = get_model_path(model_type, name)
+
+    if "url" in entry:
+        download_once(destination, lambda: download_file(entry["url"], destination, entry.get("sha256")))
+    elif "s3" in entry:
+        download_once(destination, lambda: download_from_s3(entry["s3"], destination, entry.get("sha256")))
+    else:
+        raise Exception(f"Manifest entry for {name} has no url or s3 source")
+
+
+def prefetch_models(workflow):
+    """
+    Concurrently download every model the workflow needs that isn't on disk
+
+    Returns the (model type, name) pairs that are missing and not in the
+    manifest, so the caller can report them.
+    """
+    manifest = get_manifest()
+    to_fetch = []
+    unknown = []
+
+    for model_type, name in find_workflow_models(workflow):
+        # Baked-in and locally cached copies count; only truly missing models are fetched
+        if find_model_file(model_type, name):
+            continue
+
+        entry = manifest.get(name)
+        if entry is None or entry.get("type", model_type) != model_type:
+            unknown.append((model_type, name))
+        else:
+            to_fetch.append((model_type, name, entry))
+
+    if to_fetch:
+        print(f"Prefetching {len(to_fetch)} models: {[name for _, name, _ in to_fetch]}")
+        with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as pool:
+            futures = [pool.submit(fetch_model, *model) for model in to_fetch]
+            for future in futures:
+                future.result()
+
+    return unknown
+
+
+def local_model_path(model_type, name):
+    """Where the local tier keeps its copy of a model"""
+    return os.path.join(LOCAL_MODEL_DIR, model_type, name)
+
+
+def get_model_paths_configs():
+    """
+    Model path configs to pass to ComfyUI, in lookup order
+
+    ComfyUI uses the first folder that has a file, so a generated config for
+    the local tier goes ahead of the network volume config.
+    """
+    configs = [MODEL_PATHS_CONFIG]
+
+    if not LOCAL_MODEL_DIR or yaml is None:
+        return configs
+
+    # is_default puts these folders ahead of ComfyUI's own models/ dir
+    local_config = {
+        "local": {
+            "base_path": LOCAL_MODEL_DIR,
+            "is_default": True,
+            **{model_type: model_type for model_type in model_dirs}
+        }
+    }
+    for model_type in model_dirs:
+        os.makedirs(os.path.join(LOCAL_MODEL_DIR, model_type), exist_ok=True)
+
+    with open(LOCAL_MODEL_PATHS_CONFIG, "w") as f:
+        yaml.safe_dump(local_config, f, sort_keys=False)
+
+    return [LOCAL_MODEL_PATHS_CONFIG] + configs
+
+
+def list_local_models():
+    """Return (mtime, size, path) for every file in the local tier"""
+    entries = []
+
+    for root, dirs, files in os.walk(LOCAL_MODEL_DIR):
+        for filename in files:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    return entries
+
+
+def make_local_room(needed_bytes):
+    """Evict least recently used local copies until needed_bytes fits; False if it can't"""
+    entries = sorted(list_local_models())
+    total_bytes = sum(size for _, size, _ in entries)
+
+    def fits():
+        free_bytes = shutil.disk_usage(LOCAL_MODEL_DIR).free
+        return (total_bytes + needed_bytes <= LOCAL_MODEL_MAX_BYTES
+                and free_bytes - needed_bytes >= LOCAL_MODEL_RESERVE_BYTES)
+
+    for mtime, size, path in entries:
+        if fits():
+            return True
+        # ComfyUI keeps already-open weights alive after the file is unlinked
+        os.remove(path)
+        total_bytes -= size
+        print(f"Evicted local model copy: {path}")
+
+    return fits()
+
+
+def copy_to_local_tier(model_type, name):
+    """Copy one model from the network volume to local disk"""
+    source = get_model_path(model_type, name)
+    destination = local_model_path(model_type, name)
+
+    if os.path.exists(destination) or not os.path.exists(source):
+        return
+
+    size = os.path.getsize(source)
+    if size > LOCAL_MODEL_MAX_BYTES or not make_local_room(size):
+        print(f"Not enough local space to cache {name}")
+        return
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    tmp_path = f"{destination}.{uuid.uuid4().hex}.tmp"
+    try:
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, destination)
+        print(f"Cached {name} on local disk")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def run_promotions():
+    """Background worker that copies queued models to the local tier one at a time"""
+    while True:
+        model_type, name = promotion_queue.get()
+        try:
+            copy_to_local_tier(model_type, name)
+        except OSError as e:
+            print(f"Failed to cache {name} locally: {e}")
+        finally:
+            with promotion_lock:
+                promotions_pending.discard((model_type, name))
+
+
+def promote_models(required):
+    """
+    Mark models as recently used on the local tier, queueing a copy for any
+    that aren't there yet
+    """
+    global promotion_thread
+
+    if not LOCAL_MODEL_DIR:
+        return
+
+    for model_type, name in required:
+        local_path = local_model_path(model_type, name)
+        if os.path.exists(local_path):
+            os.utime(local_path)
+            continue
+
+        with promotion_lock:
+            if (model_type, name) in promotions_pending:
+                continue
+            promotions_pending.add((model_type, name))
+
+            if promotion_thread is None:
+                promotion_thread = threading.Thread(target=run_promotions, name="model-promotion", daemon=True)
+                promotion_thread.start()
+
+        promotion_queue.put((model_type, name))
+
+
+def resolve_model_file(model_type, name):
+    """The file ComfyUI will actually load: the first copy along its search path"""
+    return find_model_file(model_type, name) or get_model_path(model_type, name)
+
+
+def get_model_size(model_type, name):
+    """Size in bytes of the file ComfyUI will load, else the manifest's size, else None"""
+    try:
+        return os.path.getsize(resolve_model_file(model_type, name))
+    except OSError:
+        pass
+
+    entry = get_manifest().get(name)
+    if entry and entry.get("type", model_type) == model_type:
+        return entry.get("size")
+    return None
+
+
+def get_available_memory():
+    """MemAvailable from /proc/meminfo in bytes, or None if unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def readahead_file(path, buffer):
+    """Pull a file into the OS page cache"""
+    with open(path, "rb", buffering=0) as f:
+        # A hint for local disks; network filesystems mostly ignore it,
+        # so the sequential read below is what actually warms the cache
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while f.readinto(buffer):
+            pass
+
+
+def readahead_models(required):
+    """Read model files sequentially so the first load hits the page cache"""
+    available = get_available_memory()
+    budget = available * READAHEAD_MEMORY_FRACTION if available else None
+    buffer = bytearray(READAHEAD_CHUNK_SIZE)
+    total_bytes = 0
+
+    for model_type, name in required:
+        path = resolve_model_file(model_type, name)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+
+        if budget is not None and total_bytes + size > budget:
+            print(f"Readahead budget reached, skipping {name}")
+            continue
+
+        start_time = time.time()
+        try:
+            readahead_file(path, buffer)
+        except OSError as e:
+            print(f"Readahead failed for {name}: {e}")
+            continue
+
+        total_bytes += size
+        elapsed = max(time.time() - start_time, 0.001)
+        print(f"Read ahead {name} ({size / elapsed / 1e6:.0f} MB/s)")
+
+
+def start_readahead(required):
+    """Run readahead_models on a background thread"""
+    if required:
+        threading.Thread(target=readahead_models, args=(required,), name="model-readahead", daemon=True).start()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Model residency tracking for the shared ComfyUI server
+
+ComfyUI keeps the models of recent prompts loaded and only evicts them
+when a new load runs out of room, which on a busy worker shows up as
+out-of-memory retries and slow reloads when traffic alternates between
+pipelines. The manager below remembers which models recent jobs loaded and,
+when the next job's models won't fit in the free VRAM reported by
+/system_stats, asks ComfyUI to unload everything through /free first.
+ComfyUI also unloads models on its own, so before every job the manager
+forgets its least recently used entries until they fit in the VRAM
+/system_stats says is in use.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+# Headroom for activations and intermediate latents on top of model weights
+RESIDENCY_OVERHEAD_BYTES = int(os.environ.get("RESIDENCY_OVERHEAD_BYTES", str(2 * 1024 ** 3)))
+
+# 0/false disables the /free calls; jobs are still tracked
+RESIDENCY_MANAGER = os.environ.get("RESIDENCY_MANAGER", "1").lower() in ("1", "true", "yes")
+
+
+def get_vram_free(stats):
+    """Free VRAM in bytes on the first GPU in a /system_stats response, or None"""
+    for device in stats.get("devices", []):
+        if device.get("type") == "cuda" and "vram_free" in device:
+            return device["vram_free"]
+    return None
+
+
+def get_vram_used(stats):
+    """VRAM in use on the first GPU in a /system_stats response, or None"""
+    for device in stats.get("devices", []):
+        if device.get("type") == "cuda" and "vram_free" in device and "vram_total" in device:
+            return device["vram_total"] - device["vram_free"]
+    return None
+
+
+class ResidencyManager:
+    """
+    Decide when to unload ComfyUI's models before queueing a job
+
+    client needs system_stats() and free(unload_models, free_memory), like
+    ComfyUIClient; model_size(model_type, name) returns a model's size in
+    bytes or None. Both are parameters so the manager can be driven by a
+    stub server in tests.
+    """
+
+    def __init__(self, client, model_size, overhead_bytes=RESIDENCY_OVERHEAD_BYTES, enabled=True):
+        self.client = client
+        self.model_size = model_size
+        self.overhead_bytes = overhead_bytes
+        self.enabled = enabled
+        # (model type, name) -> size, least recently used first
+        self.resident = OrderedDict()
+        self.lock = threading.Lock()
+
+    def required_bytes(self, required):
+        """Bytes still to load for the given models, plus working headroom"""
+        needed = self.overhead_bytes
+        for model in required:
+            if model in self.resident:
+                continue
+            size = self.model_size(*model)
+            if size:
+                needed += size
+        return needed
+
+    def forget_unloaded(self, vram_used):
+        """Drop least recently used entries until they fit in the VRAM ComfyUI is using"""
+        resident_bytes = sum(self.resident.values())
+        while self.resident and resident_bytes > vram_used:
+            _, size = self.resident.popitem(last=False)
+            resident_bytes -= size
+
+    def prepare(self, required):
+        """
+        Free ComfyUI's memory if the job's models won't fit alongside the resident ones
+
+        Returns True when /free was called. ComfyUI applies /free between
+        prompts, so a prompt that is already running is not disturbed.
+        """
+        if not self.enabled or not required:
+            return False
+
+        with self.lock:
+            try:
+                stats = self.client.system_stats()
+            except Exception as e:
+                print(f"Could not read ComfyUI memory stats: {e}")
+                return False
+
+            vram_used = get_vram_used(stats)
+            if vram_used is not None:
+                self.forget_unloaded(vram_used)
+
+            needed = self.required_bytes(required)
+            if needed == self.overhead_bytes:
+                # Everything the job needs is still loaded
+                return False
+
+            vram_free = get_vram_free(stats)
+            if vram_free is None or needed <= vram_free:
+                return False
+
+            evicted = [name for _, name in self.resident]
+            print(f"Job needs {needed / 1024 ** 3:.1f} GB with {vram_free / 1024 ** 3:.1f} GB free, "
+                  f"unloading {evicted or 'cached models'}")
+
+            try:
+                self.client.free(unload_models=True, free_memory=True)
+            except Exception as e:
+                print(f"Failed to free ComfyUI memory: {e}")
+                return False
+
+            self.resident.clear()
+            return True
+
+    def mark_used(self, required):
+        """Record models a finished job left loaded"""
+        with self.lock:
+            for model in required:
+                if model in self.resident:
+                    self.resident.move_to_end(model)
+                else:
+                    self.resident[model] = self.model_size(*model) or 0
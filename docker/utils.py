@@ -4,52 +4,391 @@ Utility functions for ComfyUI serverless handler
 """
 
 import os
-import shutil
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
 import requests
 import boto3
+from io import BytesIO
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from pathlib import Path
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Model downloads - large files are fetched as parallel HTTP Range segments
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "8"))
+DOWNLOAD_SEGMENT_MIN_BYTES = 64 * 1024 * 1024  # Smaller files use one connection
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = (10, 60)  # Connect, read
+PROGRESS_SAVE_INTERVAL = 5  # Seconds between .partial progress checkpoints
+
+# Cross-worker download locks on the shared volume. The holder refreshes the
+# lock's mtime while downloading; a lock not refreshed for this long is stale.
+DOWNLOAD_LOCK_STALE = int(os.environ.get("DOWNLOAD_LOCK_STALE", "120"))
+DOWNLOAD_LOCK_POLL = 2
+
+# S3 transfers - one shared client; S3_ENDPOINT_URL points it at MinIO or moto locally
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+S3_UPLOAD_WORKERS = int(os.environ.get("S3_UPLOAD_WORKERS", "8"))
+S3_MULTIPART_CONCURRENCY = int(os.environ.get("S3_MULTIPART_CONCURRENCY", "8"))
+S3_URL_EXPIRY = 604800  # 7 days
+
+s3_transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=S3_MULTIPART_CONCURRENCY
+)
+s3_client = None
+s3_client_lock = threading.Lock()
+
+# (bucket, key) pairs known to exist, so repeated content skips the HEAD too
+s3_known_keys = set()
+upload_pool = ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS, thread_name_prefix="s3-upload")
+
+
+def probe_download(url):
+    """Return (size, supports_ranges) for a URL, following redirects"""
+    response = requests.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
 
+    size = int(response.headers.get("Content-Length", 0)) or None
+    supports_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return size, supports_ranges
+
+
+def file_sha256(path):
+    """Hex SHA-256 of a file on disk"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_sha256(path, expected):
+    """Raise if a downloaded file doesn't match its expected SHA-256"""
+    if not expected:
+        return
+
+    actual = file_sha256(path)
+    if actual != expected.lower():
+        os.remove(path)
+        raise Exception(f"Checksum mismatch for {path}: expected {expected}, got {actual}")
+
+
+def load_progress(progress_path, size):
+    """Load segment progress for a resumable download, or None if it doesn't match"""
+    try:
+        with open(progress_path) as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    return progress if progress.get("size") == size else None
+
+
+def save_progress(progress_path, progress):
+    """Checkpoint segment progress next to the .partial file"""
+    tmp_path = f"{progress_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+
+def download_segment(url, partial_path, segment, lock, checkpoint):
+    """Fetch one byte range into its place in the .partial file, resuming on failure"""
+    for attempt in range(DOWNLOAD_RETRIES):
+        start = segment["start"] + segment["done"]
+        if start > segment["end"]:
+            return
+
+        try:
+            headers = {"Range": f"bytes={start}-{segment['end']}"}
+            with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code != 206:
+                    raise Exception(f"Range request returned {response.status_code}")
+
+                with open(partial_path, "r+b") as f:
+                    f.seek(start)
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        with lock:
+                            segment["done"] += len(chunk)
+                        checkpoint()
+
+            # A body that ends early without an error is resumed like a failure
+            if segment["start"] + segment["done"] > segment["end"]:
+                return
+            error = f"ended at byte {segment['start'] + segment['done']}"
+        except (requests.exceptions.RequestException, OSError) as e:
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            error = e
+
+        print(f"Segment {segment['start']}-{segment['end']} failed ({error}), retrying...")
+        time.sleep(2 ** attempt)
+
+
+def download_segmented(url, partial_path, size, connections):
+    """Download a file as parallel byte ranges, resuming from a previous .partial"""
+    progress_path = f"{partial_path}.json"
+    progress = load_progress(progress_path, size) if os.path.exists(partial_path) else None
+
+    if progress is None:
+        segment_size = -(-size // connections)
+        progress = {
+            "size": size,
+            "segments": [
+                {"start": start, "end": min(start + segment_size, size) - 1, "done": 0}
+                for start in range(0, size, segment_size)
+            ]
+        }
+        with open(partial_path, "wb") as f:
+            f.truncate(size)
+    else:
+        done = sum(segment["done"] for segment in progress["segments"])
+        print(f"Resuming download at {done}/{size} bytes")
+
+    lock = threading.Lock()
+    last_saved = [time.monotonic()]
+
+    def checkpoint(force=False):
+        with lock:
+            if force or time.monotonic() - last_saved[0] > PROGRESS_SAVE_INTERVAL:
+                save_progress(progress_path, progress)
+                last_saved[0] = time.monotonic()
+
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            futures = [
+                pool.submit(download_segment, url, partial_path, segment, lock, checkpoint)
+                for segment in progress["segments"]
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        checkpoint(force=True)
+
+    # The .partial is pre-sized, so its length says nothing; check every segment.
+    # The progress file stays so the next attempt resumes the short ones.
+    incomplete = [
+        segment for segment in progress["segments"]
+        if segment["done"] != segment["end"] - segment["start"] + 1
+    ]
+    if incomplete:
+        raise Exception(
+            f"Incomplete download of {url}: {len(incomplete)} segments short, "
+            f"first at byte {incomplete[0]['start'] + incomplete[0]['done']}"
+        )
+
+    os.remove(progress_path)
+
+
+def download_single(url, partial_path, supports_ranges):
+    """Download over one connection, appending to an existing .partial when possible"""
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset and supports_ranges else {}
+
+    with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        # The .partial already holds the whole file
+        if response.status_code == 416 and offset:
+            return
+        response.raise_for_status()
+
+        # 206 means the server honoured the resume offset
+        mode = "ab" if response.status_code == 206 else "wb"
+        if mode == "ab":
+            print(f"Resuming download at {offset} bytes")
+
+        with open(partial_path, mode, buffering=DOWNLOAD_CHUNK_SIZE) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+
+def download_file(url, destination, sha256=None, connections=DOWNLOAD_CONNECTIONS):
+    """
+    Download a file from URL to destination
 
-def download_file(url, destination):
-    """Download a file from URL to destination"""
+    Data goes to destination + ".partial" and is renamed into place only once
+    complete (and matching sha256, if given), so an interrupted download is
+    resumed next time instead of leaving a truncated model behind.
+    """
     print(f"Downloading {url} to {destination}")
 
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    partial_path = f"{destination}.partial"
+    start_time = time.time()
+
+    try:
+        size, supports_ranges = probe_download(url)
+    except requests.exceptions.RequestException as e:
+        print(f"HEAD request failed ({e}), downloading over one connection")
+        size, supports_ranges = None, False
+
+    progress_path = f"{partial_path}.json"
+    segmented = size and supports_ranges and (
+        (size >= DOWNLOAD_SEGMENT_MIN_BYTES and connections > 1)
+        or load_progress(progress_path, size) is not None
+    )
 
+    if segmented:
+        download_segmented(url, partial_path, size, connections)
+    else:
+        # A segmented .partial is pre-sized and full of holes, not a prefix to append to
+        if os.path.exists(progress_path):
+            print(f"Discarding segmented partial download of {destination}")
+            for path in (partial_path, progress_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        download_single(url, partial_path, supports_ranges)
+
+    if size and os.path.getsize(partial_path) != size:
+        raise Exception(f"Incomplete download of {url}: {os.path.getsize(partial_path)}/{size} bytes")
+
+    verify_sha256(partial_path, sha256)
+    os.replace(partial_path, destination)
+
+    elapsed = max(time.time() - start_time, 0.001)
+    print(f"Downloaded {destination} ({os.path.getsize(destination) / elapsed / 1e6:.1f} MB/s)")
+
+
+def acquire_download_lock(lock_path):
+    """Atomically create the lock file; returns this worker's token if it now owns it, else None"""
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+
+    token = uuid.uuid4().hex
+    with os.fdopen(fd, "w") as f:
+        json.dump({"host": socket.gethostname(), "pid": os.getpid(), "created": time.time(), "token": token}, f)
+    return token
+
+
+def owns_download_lock(lock_path, token):
+    """True if the lock file still carries our token"""
+    try:
+        with open(lock_path) as f:
+            return json.load(f).get("token") == token
+    except (OSError, ValueError):
+        return False
+
+
+def keep_lock_alive(lock_path, stop):
+    """Refresh the lock's mtime until stop is set so waiters know we're alive"""
+    while not stop.wait(DOWNLOAD_LOCK_STALE / 4):
+        try:
+            os.utime(lock_path)
+        except OSError:
+            return
+
+
+def break_stale_lock(lock_path):
+    """Remove a lock whose holder stopped refreshing it; True if it was removed"""
+    try:
+        if time.time() - os.path.getmtime(lock_path) < DOWNLOAD_LOCK_STALE:
+            return False
+
+        # Move it aside, then check the file we actually moved: another waiter may
+        # have broken the stale lock and taken a fresh one since the check above
+        stale_path = f"{lock_path}.{uuid.uuid4().hex}.stale"
+        os.rename(lock_path, stale_path)
+    except FileNotFoundError:
+        return False
+
+    try:
+        if time.time() - os.path.getmtime(stale_path) < DOWNLOAD_LOCK_STALE:
+            # Put a live lock back without overwriting one taken meanwhile
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+            return False
+    finally:
+        os.remove(stale_path)
+
+    print(f"Removed stale download lock: {lock_path}")
+    return True
+
+
+def download_once(destination, fetch):
+    """
+    Run fetch() to create destination unless another worker already is
+
+    Workers scaling up together share the volume, so exactly one of them holds
+    destination + ".lock" and downloads; the others wait for the file to
+    appear and reuse it. If the holder dies its .partial is resumed by
+    whoever takes over the stale lock.
+    """
+    lock_path = f"{destination}.lock"
     os.makedirs(os.path.dirname(destination), exist_ok=True)
+    waited_since = None
+
+    while not os.path.exists(destination):
+        token = acquire_download_lock(lock_path)
+        if token:
+            stop = threading.Event()
+            threading.Thread(
+                target=keep_lock_alive,
+                args=(lock_path, stop),
+                name="download-lock",
+                daemon=True
+            ).start()
+
+            try:
+                # Another worker may have finished between our check and the lock
+                if os.path.exists(destination):
+                    return
+                # Or judged our lock stale and taken it over; never share a .partial
+                if not owns_download_lock(lock_path, token):
+                    continue
+                fetch()
+            finally:
+                stop.set()
+                # Only remove the lock if it is still ours
+                if owns_download_lock(lock_path, token):
+                    try:
+                        os.remove(lock_path)
+                    except FileNotFoundError:
+                        pass
+            return
+
+        if break_stale_lock(lock_path):
+            continue
 
-    with open(destination, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+        if waited_since is None:
+            waited_since = time.time()
+            print(f"Another worker is downloading {destination}, waiting...")
 
-    print(f"Downloaded {destination}")
+        time.sleep(DOWNLOAD_LOCK_POLL)
+
+    if waited_since is not None:
+        print(f"Reusing {destination} downloaded by another worker ({time.time() - waited_since:.0f}s wait)")
 
 
-def download_models(models_config):
+def download_models(models_config, model_dirs):
     """
     Download models from URLs or S3
 
     models_config format:
     {
         "checkpoints": [
-            {"url": "https://...", "filename": "model.safetensors"},
+            {"url": "https://...", "filename": "model.safetensors", "sha256": "..."},
             {"s3": "s3://bucket/path/model.safetensors", "filename": "model.safetensors"}
         ],
         "loras": [...],
         "vae": [...]
     }
+
+    model_dirs maps each model type to the folder ComfyUI loads it from.
     """
-    COMFYUI_PATH = "/comfyui"
-
-    model_types = {
-        "checkpoints": f"{COMFYUI_PATH}/models/checkpoints",
-        "loras": f"{COMFYUI_PATH}/models/loras",
-        "vae": f"{COMFYUI_PATH}/models/vae",
-        "embeddings": f"{COMFYUI_PATH}/models/embeddings",
-        "controlnet": f"{COMFYUI_PATH}/models/controlnet",
-    }
+    model_types = model_dirs
 
     for model_type, models in models_config.items():
         if model_type not in model_types:
@@ -65,7 +404,7 @@ def download_models(models_config):
                 destination = os.path.join(destination_dir, filename)
 
                 if not os.path.exists(destination):
-                    download_file(model, destination)
+                    download_once(destination, lambda: download_file(model, destination))
             elif isinstance(model, dict):
                 filename = model.get("filename")
 
@@ -81,12 +420,12 @@ def download_models(models_config):
                     continue
 
                 if "url" in model:
-                    download_file(model["url"], destination)
+                    download_once(destination, lambda: download_file(model["url"], destination, model.get("sha256")))
                 elif "s3" in model:
-                    download_from_s3(model["s3"], destination)
+                    download_once(destination, lambda: download_from_s3(model["s3"], destination, model.get("sha256")))
 
 
-def download_from_s3(s3_path, destination):
+def download_from_s3(s3_path, destination, sha256=None):
     """Download file from S3"""
     # Parse s3://bucket/key format
     if s3_path.startswith("s3://"):
@@ -98,45 +437,122 @@ def download_from_s3(s3_path, destination):
 
     print(f"Downloading from S3: s3://{bucket}/{key}")
 
-    s3 = boto3.client('s3')
     os.makedirs(os.path.dirname(destination), exist_ok=True)
-    s3.download_file(bucket, key, destination)
+
+    # Same .partial + rename scheme as download_file
+    partial_path = f"{destination}.partial"
+    get_s3_client().download_file(bucket, key, partial_path, Config=s3_transfer_config)
+    verify_sha256(partial_path, sha256)
+    os.replace(partial_path, destination)
 
     print(f"Downloaded {destination}")
 
 
-def upload_to_s3(filepath, bucket, prefix=""):
-    """Upload file to S3 and return URL"""
-    s3 = boto3.client('s3')
+def get_s3_client():
+    """
+    Shared S3 client, created on first use
+
+    boto3 clients are thread-safe, so uploads and downloads reuse one client
+    and its connection pool instead of paying for credential lookup and a new
+    TLS handshake per file.
+    """
+    global s3_client
+
+    with s3_client_lock:
+        if s3_client is None:
+            # Every upload thread runs up to S3_MULTIPART_CONCURRENCY part uploads
+            pool_size = S3_UPLOAD_WORKERS * S3_MULTIPART_CONCURRENCY
+            s3_client = boto3.client(
+                's3',
+                endpoint_url=S3_ENDPOINT_URL,
+                config=Config(max_pool_connections=pool_size, retries={"mode": "adaptive"})
+            )
+
+    return s3_client
+
+
+def put_s3_object(filepath, bucket, key, data=None):
+    """Upload a file, or the given bytes, to one key with the shared transfer settings"""
+    if data is None:
+        get_s3_client().upload_file(filepath, bucket, key, Config=s3_transfer_config)
+    else:
+        get_s3_client().upload_fileobj(BytesIO(data), bucket, key, Config=s3_transfer_config)
+
+
+def upload_to_s3(filepath, bucket, prefix="", data=None):
+    """Upload file to S3 and return URL; with data, those bytes are uploaded under the file's name"""
+    s3 = get_s3_client()
 
     filename = os.path.basename(filepath)
     key = f"{prefix}{filename}" if prefix else filename
 
     print(f"Uploading {filepath} to s3://{bucket}/{key}")
 
-    s3.upload_file(filepath, bucket, key)
+    put_s3_object(filepath, bucket, key, data)
 
-    # Generate URL (valid for 7 days)
+    # Presigning is a local signature, no request is made
     url = s3.generate_presigned_url(
         'get_object',
         Params={'Bucket': bucket, 'Key': key},
-        ExpiresIn=604800  # 7 days
+        ExpiresIn=S3_URL_EXPIRY
     )
 
     return url
 
 
-def cleanup_outputs(output_dir, max_age_minutes=60):
-    """Clean up old output files"""
-    now = datetime.now()
+def s3_object_exists(bucket, key):
+    """Check for an object with HEAD, remembering keys that exist"""
+    if (bucket, key) in s3_known_keys:
+        return True
+
+    try:
+        get_s3_client().head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+    s3_known_keys.add((bucket, key))
+    return True
+
+
+def upload_to_s3_by_hash(filepath, bucket, prefix="", data=None):
+    """
+    Upload a file under the SHA-256 of its bytes, skipping content that's already there
+
+    With data, those bytes are hashed and uploaded and filepath only supplies
+    the extension. Returns {"url", "key", "sha256", "uploaded"}.
+    """
+    s3 = get_s3_client()
 
-    for filename in os.listdir(output_dir):
-        filepath = os.path.join(output_dir, filename)
+    digest = file_sha256(filepath) if data is None else hashlib.sha256(data).hexdigest()
+    extension = os.path.splitext(filepath)[1].lower()
+    key = f"{prefix}{digest}{extension}"
 
-        if os.path.isfile(filepath):
-            file_time = datetime.fromtimestamp(os.path.getmtime(filepath))
-            age = now - file_time
+    uploaded = not s3_object_exists(bucket, key)
+    if uploaded:
+        print(f"Uploading {filepath} to s3://{bucket}/{key}")
+        put_s3_object(filepath, bucket, key, data)
+        s3_known_keys.add((bucket, key))
+    else:
+        print(f"s3://{bucket}/{key} already exists, skipping upload")
 
-            if age > timedelta(minutes=max_age_minutes):
-                print(f"Removing old file: {filepath}")
-                os.remove(filepath)
+    url = s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=S3_URL_EXPIRY
+    )
+
+    return {"url": url, "key": key, "sha256": digest, "uploaded": uploaded}
+
+
+def submit_s3_upload(filepath, bucket, prefix="", content_addressed=False, data=None):
+    """
+    Start an upload on the upload pool and return its future
+
+    Pass data to upload encoded bytes that were never written to disk;
+    filepath then only names the object.
+    """
+    if content_addressed:
+        return upload_pool.submit(upload_to_s3_by_hash, filepath, bucket, prefix, data)
+    return upload_pool.submit(upload_to_s3, filepath, bucket, prefix, data)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Preflight checks for workflows before they are queued
+
+Model and input folders are indexed once at boot and rescanned only when
+a folder's mtime changes, so checking every loader and LoadImage
+reference costs set lookups rather than filesystem calls.
+"""
+
+import os
+import threading
+from models import MODEL_LOADER_INPUTS, get_model_search_dirs
+
+
+class FileIndex:
+    """Relative paths of the files under a set of folders, rescanned when a folder changes"""
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.files = set()
+        # Folder -> mtime at the last scan; None for roots that didn't exist
+        self.dir_mtimes = {}
+        self.lock = threading.Lock()
+
+    def scan(self):
+        """Rebuild the index; callers hold self.lock"""
+        files = set()
+        dir_mtimes = {}
+
+        for root in self.roots:
+            pending = [root]
+            while pending:
+                current = pending.pop()
+                try:
+                    dir_mtimes[current] = os.stat(current).st_mtime
+                    iterator = os.scandir(current)
+                except OSError:
+                    dir_mtimes[current] = None
+                    continue
+
+                with iterator:
+                    for entry in iterator:
+                        try:
+                            if entry.is_dir():
+                                pending.append(entry.path)
+                            else:
+                                files.add(os.path.relpath(entry.path, root))
+                        except OSError:
+                            continue
+
+        self.files = files
+        self.dir_mtimes = dir_mtimes
+
+    def changed(self):
+        """True if any indexed folder was added to, removed from or appeared since the last scan"""
+        for path, mtime in self.dir_mtimes.items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                if mtime is not None:
+                    return True
+        return not self.dir_mtimes
+
+    def contains(self, relative_path):
+        """Look a file up, rescanning first only on a miss in a folder that changed"""
+        if relative_path in self.files:
+            return True
+
+        with self.lock:
+            if self.changed():
+                self.scan()
+
+        return relative_path in self.files
+
+
+class WorkflowValidator:
+    """Checks API-format workflows against the model and input indexes"""
+
+    def __init__(self, input_dir):
+        self.input_index = FileIndex([input_dir])
+        self.model_indexes = {}
+        # class_type names ComfyUI reported in /object_info; None until known
+        self.node_types = None
+
+    def model_index(self, model_type):
+        """The index for one model type, created on first use"""
+        if model_type not in self.model_indexes:
+            self.model_indexes[model_type] = FileIndex(get_model_search_dirs(model_type))
+        return self.model_indexes[model_type]
+
+    def build(self):
+        """Index every known model folder and the input folder up front"""
+        for model_types in MODEL_LOADER_INPUTS.values():
+            for model_type in model_types.values():
+                self.model_index(model_type)
+
+        for index in [self.input_index, *self.model_indexes.values()]:
+            with index.lock:
+                index.scan()
+
+    def set_node_types(self, node_types):
+        """Enable the class_type check with the node types ComfyUI has loaded"""
+        self.node_types = set(node_types)
+
+    def validate(self, workflow):
+        """
+        Return a list of problems with the workflow, empty if it looks runnable
+
+        Each problem is {"node_id", "class_type", "type", "message"} plus
+        "input" when one input is at fault. Types are invalid_node,
+        unknown_class_type, dangling_link, missing_model and missing_image.
+        """
+        errors = []
+
+        def error(node_id, class_type, error_type, message, input_name=None):
+            problem = {"node_id": node_id, "class_type": class_type, "type": error_type, "message": message}
+            if input_name is not None:
+                problem["input"] = input_name
+            errors.append(problem)
+
+        for node_id, node_data in workflow.items():
+            if not isinstance(node_data, dict) or not isinstance(node_data.get("class_type"), str):
+                error(node_id, None, "invalid_node", "Node has no class_type")
+                continue
+
+            class_type = node_data["class_type"]
+            inputs = node_data.get("inputs", {})
+
+            if self.node_types is not None and class_type not in self.node_types:
+                error(node_id, class_type, "unknown_class_type", f"Node type {class_type} is not installed")
+
+            for input_name, value in inputs.items():
+                # Links are [source node id, output index]
+                if (isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+                        and str(value[0]) not in workflow):
+                    error(node_id, class_type, "dangling_link",
+                          f"Input {input_name} links to missing node {value[0]}", input_name)
+
+            for input_name, model_type in MODEL_LOADER_INPUTS.get(class_type, {}).items():
+                name = inputs.get(input_name)
+                if isinstance(name, str) and not self.model_index(model_type).contains(name):
+                    error(node_id, class_type, "missing_model", f"Model not found: {model_type}/{name}", input_name)
+
+            if class_type == "LoadImage":
+                image = inputs.get("image")
+                if isinstance(image, str) and not self.has_input(image):
+                    error(node_id, class_type, "missing_image", f"Input image not found: {image}", "image")
+
+        return errors
+
+    def has_input(self, image):
+        """Check a LoadImage value, which may carry an [input]/[output]/[temp] annotation"""
+        if image.endswith(("[output]", "[temp]")):
+            # Resolved by ComfyUI against its other folders
+            return True
+        if image.endswith("[input]"):
+            image = image[:-len("[input]")].rstrip()
+        return self.input_index.contains(os.path.normpath(image))
@@ -10,14 +10,68 @@ import sys
 import os
 import time
 import base64
+import random
+import hashlib
+import argparse
+import itertools
 import subprocess
+import threading
+import uuid
 from pathlib import Path
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import ijson  # Optional: parse large responses without loading them whole
+except ImportError:
+    ijson = None
 
 
 # Configuration - UPDATE THESE
 RUNPOD_API_KEY = os.environ.get("RUNPOD_API_KEY", "")
 RUNPOD_ENDPOINT_ID = os.environ.get("RUNPOD_ENDPOINT_ID", "")
 
+RUNPOD_API_URL = "https://api.runpod.ai/v2"
+
+# Seconds /runsync holds the request open waiting for the result; 0 submits with /run
+RUNSYNC_WAIT = float(os.environ.get("RUNSYNC_WAIT", "30"))
+
+# Status polling starts fast and backs off, with jitter, while the job is queued or running
+POLL_INITIAL = 0.5
+POLL_MAX_QUEUED = 10.0  # Cold starts can take minutes
+POLL_MAX_RUNNING = 4.0  # Once running, results are usually close
+STREAM_POLL_MIN = 0.2
+API_RETRIES = 6  # Attempts for rate-limited (429) or failing (5xx) API calls
+
+FINISHED_STATUSES = ("COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT")
+
+# Base64 is decoded to disk this many characters at a time (a multiple of 4)
+DECODE_CHUNK_CHARS = 4 * 1024 * 1024
+# Parallel downloads of S3 result URLs
+DOWNLOAD_WORKERS = 8
+
+# Hashes of reference images each endpoint has received, so repeats go hash-only (empty disables)
+REFERENCE_MANIFEST = os.environ.get(
+    "REFERENCE_MANIFEST", os.path.expanduser("~/.cache/comfy-serverless/reference_hashes.json")
+)
+# Parallel hashing and base64 encoding of reference images
+ENCODE_WORKERS = 4
+# Nodes whose "image" input names a file in ComfyUI's input folder
+IMAGE_LOADERS = ("LoadImage", "LoadImageMask")
+
+# Sampler inputs set by --seeds
+SEED_INPUTS = ("seed", "noise_seed")
+
+# Serializes appends to results.jsonl across batch threads
+results_lock = threading.Lock()
+
+# Reference hashes the endpoint already has, loaded from REFERENCE_MANIFEST on first use
+seen_references = None
+manifest_lock = threading.Lock()
+
+# Path -> (size, mtime_ns, sha256), so batch jobs hash each reference image once
+file_hashes = {}
+
 
 def open_image(filepath):
     """Open an image file with xdg-open"""
@@ -27,56 +81,544 @@ def open_image(filepath):
         print(f"Warning: Could not open image: {e}")
 
 
-def upload_reference_images(reference_dir):
+def find_workflow_images(workflow):
+    """Filenames read by the workflow's LoadImage and LoadImageMask nodes"""
+    images = set()
+    for node_data in workflow.values():
+        if isinstance(node_data, dict) and node_data.get("class_type") in IMAGE_LOADERS:
+            image = node_data.get("inputs", {}).get("image")
+            if isinstance(image, str):
+                images.add(image)
+    return images
+
+
+def hash_file(path):
+    """SHA-256 of a file, reused until its size or mtime changes"""
+    stat = os.stat(path)
+    cached = file_hashes.get(path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    file_hashes[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def encode_file(path):
+    """Base64 of a file's contents"""
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
+
+def read_reference_manifest():
+    """The whole manifest, {endpoint id: [sha256, ...]}"""
+    try:
+        with open(REFERENCE_MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_seen_references():
+    """Hashes this endpoint is known to have cached; callers hold manifest_lock"""
+    global seen_references
+    if seen_references is None:
+        seen_references = set(read_reference_manifest().get(RUNPOD_ENDPOINT_ID, []))
+    return seen_references
+
+
+def update_seen_references(add=(), remove=()):
+    """Record reference hashes the endpoint now has or has lost, and save the manifest"""
+    if not REFERENCE_MANIFEST:
+        return
+
+    with manifest_lock:
+        seen = get_seen_references()
+        before = set(seen)
+        seen.update(add)
+        seen.difference_update(remove)
+        if seen == before:
+            return
+
+        # Re-read so other endpoints' entries written by other runs are kept
+        manifest = read_reference_manifest()
+        manifest[RUNPOD_ENDPOINT_ID] = sorted(seen)
+
+        os.makedirs(os.path.dirname(REFERENCE_MANIFEST) or ".", exist_ok=True)
+        temp_path = f"{REFERENCE_MANIFEST}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, REFERENCE_MANIFEST)
+
+
+def upload_reference_images(reference_dir, workflow, resend=()):
     """
-    Read all images from reference directory and encode as base64
+    Build reference_images for the files in reference_dir that the workflow loads
 
-    Returns dict: {filename: base64_data}
+    Returns {filename: {"sha256": ..., "data": base64}}. Images whose hash
+    the endpoint has already received are sent without "data"; hashes in
+    resend always carry it.
     """
+    if not os.path.isdir(reference_dir):
+        return {}
+
+    # The worker only redirects LoadImage inputs that match a reference name exactly
+    filenames = sorted(
+        name for name in find_workflow_images(workflow)
+        if os.path.basename(name) == name and os.path.isfile(os.path.join(reference_dir, name))
+    )
+    if not filenames:
+        return {}
+
+    paths = [os.path.join(reference_dir, name) for name in filenames]
+
+    with manifest_lock:
+        seen = set(get_seen_references()) if REFERENCE_MANIFEST else set()
+
+    with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as pool:
+        digests = list(pool.map(hash_file, paths))
+        to_send = [
+            i for i, digest in enumerate(digests)
+            if digest not in seen or digest in resend
+        ]
+        encoded = dict(zip(to_send, pool.map(encode_file, [paths[i] for i in to_send])))
+
     reference_images = {}
+    for i, (filename, digest) in enumerate(zip(filenames, digests)):
+        reference_images[filename] = {"sha256": digest}
+        if i in encoded:
+            reference_images[filename]["data"] = encoded[i]
+            print(f"  Added reference image: {filename}")
+        else:
+            print(f"  Added reference image: {filename} (hash only)")
 
-    if not os.path.exists(reference_dir):
-        return reference_images
+    return reference_images
 
-    for filename in os.listdir(reference_dir):
-        filepath = os.path.join(reference_dir, filename)
 
-        # Only process image files
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.bmp')):
-            with open(filepath, 'rb') as f:
-                image_data = base64.b64encode(f.read()).decode('utf-8')
-                reference_images[filename] = image_data
-                print(f"  Added reference image: {filename}")
+def find_need_bytes(output):
+    """Hashes a worker asked to have resent with data, from a job output or list of chunks"""
+    chunks = output if isinstance(output, list) else [output or {}]
+    return {
+        entry["sha256"]
+        for chunk in chunks if isinstance(chunk, dict)
+        for entry in chunk.get("need_bytes", [])
+    }
 
-    return reference_images
+
+def decode_base64_to_file(data, path):
+    """Decode a base64 string into a file a slice at a time, never holding a second full copy"""
+    with open(path, "wb") as f:
+        for start in range(0, len(data), DECODE_CHUNK_CHARS):
+            f.write(base64.b64decode(data[start:start + DECODE_CHUNK_CHARS]))
 
 
-def send_workflow(workflow_file, models=None, output_dir="./outputs", reference_dir=None):
+def read_response(response, output_dir):
     """
-    Send workflow to RunPod serverless endpoint
+    Parse an API response, writing base64 image data straight to disk
 
-    Args:
-        workflow_file: Path to ComfyUI workflow JSON file
-        models: Optional dict of models to use
-        output_dir: Directory to save output images
-        reference_dir: Optional directory containing reference images to upload
+    With ijson the body is parsed as it downloads and each image's "data"
+    is decoded into a temp file in output_dir as soon as it is read, so the
+    response as a whole is never held in memory. Images then carry
+    "data_file" instead of "data"; save_images moves them into place.
+    """
+    if ijson is None:
+        return response.json()
+
+    os.makedirs(output_dir, exist_ok=True)
+    builder = ijson.ObjectBuilder()
+
+    # Undo gzip/deflate transfer encoding, which the raw stream leaves in place
+    response.raw.decode_content = True
+
+    for prefix, event, value in ijson.parse(response.raw):
+        if event == "map_key" and value == "data" and prefix.endswith("images.item"):
+            value = "data_file"
+        elif event == "string" and prefix.endswith("images.item.data"):
+            temp_path = os.path.join(output_dir, f".{uuid.uuid4().hex}.part")
+            decode_base64_to_file(value, temp_path)
+            value = temp_path
+        builder.event(event, value)
+
+    return builder.value
+
+
+def discard_decoded_images(data):
+    """
+    Delete temp files read_response decoded for images that were never saved
+
+    Walks a parsed response; data_file paths already moved into place by
+    save_images are gone and skipped.
+    """
+    if isinstance(data, dict):
+        if isinstance(data.get("data_file"), str):
+            try:
+                os.remove(data["data_file"])
+            except FileNotFoundError:
+                pass
+        for value in data.values():
+            discard_decoded_images(value)
+    elif isinstance(data, list):
+        for value in data:
+            discard_decoded_images(value)
+
+
+def save_images(images, output_dir):
+    """Write returned images into output_dir and return the saved paths"""
+    os.makedirs(output_dir, exist_ok=True)
+    saved_images = []
+
+    for i, image_data in enumerate(images):
+        filename = os.path.basename(image_data.get("filename", f"output_{i}.png"))
+        output_path = os.path.join(output_dir, filename)
+
+        if "data_file" in image_data:
+            # Already decoded while the response was read
+            os.replace(image_data["data_file"], output_path)
+        elif image_data.get("data"):
+            decode_base64_to_file(image_data.pop("data"), output_path)
+        else:
+            continue
+
+        print(f"Saved: {output_path}")
+        saved_images.append(output_path)
+
+    return saved_images
+
+
+def download_url(session, url, output_dir):
+    """Stream one result URL to output_dir and return the saved path"""
+    output_path = os.path.join(output_dir, os.path.basename(urlparse(url).path))
+
+    with session.get(url, stream=True, timeout=(10, 60)) as response:
+        response.raise_for_status()
+        with open(output_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+
+    print(f"Downloaded: {output_path}")
+    return output_path
+
+
+def download_urls(urls, output_dir):
+    """Download S3 result URLs in parallel and return the saved paths"""
+    if not urls:
+        return []
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Presigned URLs carry their own auth; the API session's bearer token would break them
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS))
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        return list(pool.map(lambda url: download_url(session, url, output_dir), urls))
+
+
+def report_error(output):
+    """Print a worker error response; returns True if there was one"""
+    if "error" not in output:
+        return False
+
+    print(f"Job failed with error: {output['error']}")
+    if "traceback" in output:
+        print(f"Traceback: {output['traceback']}")
+    if "comfyui_log" in output:
+        print("ComfyUI log:")
+        for line in output["comfyui_log"]:
+            print(f"  {line}")
+    return True
+
+
+def jitter(delay):
+    """Spread a delay by +/-25% so concurrent jobs don't poll in lockstep"""
+    return delay * random.uniform(0.75, 1.25)
+
+
+def api_request(session, method, path, **kwargs):
     """
+    Call the endpoint's API, waiting out rate limits and transient errors
+
+    Honours Retry-After on 429 responses and otherwise backs off
+    exponentially with jitter. Only GETs are retried on 5xx: a gateway error
+    on /run or /runsync may come after the job was accepted, so it is
+    returned rather than risking a second submission. Returns the last response.
+    """
+    url = f"{RUNPOD_API_URL}/{RUNPOD_ENDPOINT_ID}/{path}"
+    delay = POLL_INITIAL
+
+    for attempt in range(API_RETRIES):
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            # A POST that timed out may have been accepted; resending could run the job twice
+            if method != "GET" or attempt == API_RETRIES - 1:
+                raise
+            print(f"Request to {path} failed ({e}), retrying")
+        else:
+            if response.status_code != 429 and (response.status_code < 500 or method != "GET"):
+                return response
+
+            retry_after = response.headers.get("Retry-After", "")
+            if response.status_code == 429 and retry_after.isdigit():
+                delay = float(retry_after)
+            print(f"{path.split('?')[0].split('/')[0]} returned {response.status_code}, retrying in {delay:.1f}s")
+
+        time.sleep(jitter(delay))
+        delay = min(delay * 2, POLL_MAX_QUEUED)
+
+    return response
+
 
+def next_poll_delay(delay, job_status, last_status):
+    """Back off while queued; restart fast when the job starts running"""
+    if job_status == "IN_PROGRESS" and last_status != "IN_PROGRESS":
+        return POLL_INITIAL
+    if job_status == "IN_PROGRESS":
+        return min(delay * 1.5, POLL_MAX_RUNNING)
+    return min(delay * 2, POLL_MAX_QUEUED)
+
+
+def stream_results(session, job_id, output_dir, need_bytes=None):
+    """
+    Consume /stream/{job_id}, saving each node's images as soon as they arrive
+
+    Requires the worker to run with STREAM_OUTPUTS=1. Returns
+    (saved image paths, final job status). If a need_bytes set is passed,
+    reference hashes the worker asks for are added to it instead of being
+    reported as an error.
+    """
+    saved_images = []
+    delay = POLL_INITIAL
+    last_status = None
+    failed = False
+
+    while True:
+        response = api_request(session, "GET", f"stream/{job_id}", stream=True)
+
+        if response.status_code != 200:
+            print(f"Error reading stream: {response.status_code}")
+            return saved_images, "STREAM_FAILED"
+
+        stream_data = read_response(response, output_dir)
+        job_status = stream_data.get("status")
+        chunks = stream_data.get("stream", [])
+
+        for chunk in chunks:
+            output = chunk.get("output", {})
+            if need_bytes is not None and output.get("need_bytes"):
+                need_bytes.update(find_need_bytes(output))
+                continue
+            if report_error(output):
+                failed = True
+                continue
+
+            images = output.get("images", [])
+            if images:
+                print(f"Received {len(images)} images from node {output.get('node_id')}")
+                saved_images.extend(save_images(images, output_dir))
+            saved_images.extend(download_urls(output.get("s3_urls", []), output_dir))
+
+        # Images in error or need_bytes chunks, or of a failed job, were never saved
+        discard_decoded_images(stream_data)
+
+        if job_status == "COMPLETED":
+            return saved_images, "FAILED" if failed else "COMPLETED"
+        elif job_status in FINISHED_STATUSES:
+            print(f"Job {job_status}")
+            print(stream_data)
+            return saved_images, job_status
+
+        # More chunks tend to follow one another; an empty read backs off
+        delay = STREAM_POLL_MIN if chunks else next_poll_delay(delay, job_status, last_status)
+        last_status = job_status
+        time.sleep(jitter(delay))
+
+
+def create_session(concurrency=1):
+    """One authenticated session whose connection pool is shared by every job"""
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {RUNPOD_API_KEY}",
+        "Content-Type": "application/json"
+    })
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1))
+    session.mount("https://", adapter)
+    return session
+
+
+def check_credentials():
+    """Print setup instructions and return False if the API key or endpoint is missing"""
     if not RUNPOD_API_KEY:
         print("Error: RUNPOD_API_KEY not set")
         print("Set it with: export RUNPOD_API_KEY='your-key'")
-        return
+        return False
 
     if not RUNPOD_ENDPOINT_ID:
         print("Error: RUNPOD_ENDPOINT_ID not set")
         print("Set it with: export RUNPOD_ENDPOINT_ID='your-endpoint-id'")
-        return
+        return False
 
-    # Read workflow
-    with open(workflow_file, 'r') as f:
-        workflow = json.load(f)
+    return True
+
+
+def apply_variation(workflow, seed=None, prompt=None):
+    """
+    Return a copy of the workflow with the sampler seeds and/or positive prompts replaced
+
+    The positive prompt is every CLIPTextEncode node linked to a sampler's
+    "positive" input.
+    """
+    workflow = json.loads(json.dumps(workflow))
+
+    for node_data in workflow.values():
+        inputs = node_data.get("inputs", {})
+        if not node_data.get("class_type", "").startswith("KSampler"):
+            continue
+
+        if seed is not None:
+            for input_name in SEED_INPUTS:
+                if input_name in inputs:
+                    inputs[input_name] = seed
+
+        positive = inputs.get("positive")
+        if prompt is not None and isinstance(positive, list):
+            text_node = workflow.get(str(positive[0]), {})
+            if text_node.get("class_type") == "CLIPTextEncode":
+                text_node["inputs"]["text"] = prompt
+
+    return workflow
+
+
+def parse_seeds(value):
+    """Parse "1,2,3" or "100-149" into a list of seeds"""
+    seeds = []
+    for part in value.split(","):
+        if "-" in part.strip()[1:]:
+            start, end = part.split("-", 1)
+            seeds.extend(range(int(start), int(end) + 1))
+        else:
+            seeds.append(int(part))
+    return seeds
+
+
+def build_batch(workflow_files, seeds=None, prompts=None):
+    """
+    Expand workflow files and an optional seed/prompt sweep into (name, workflow) jobs
+
+    Every workflow is run once per seed and prompt combination.
+    """
+    jobs = []
+
+    for workflow_file in workflow_files:
+        with open(workflow_file, 'r') as f:
+            workflow = json.load(f)
+        stem = Path(workflow_file).stem
+
+        for seed, (prompt_index, prompt) in itertools.product(seeds or [None], enumerate(prompts or [None])):
+            name = stem
+            if seed is not None:
+                name += f"_seed{seed}"
+            if prompt is not None:
+                name += f"_prompt{prompt_index}"
+            jobs.append((name, apply_variation(workflow, seed, prompt)))
+
+    return jobs
+
+
+def submit_job(session, payload, output_dir, sync_wait=0):
+    """
+    Submit a job and return RunPod's response ({"id", "status", ...}), or None
 
-    # Prepare request
+    With sync_wait the job goes to /runsync, which returns the finished
+    output directly if it completes within that many seconds.
+    """
+    if sync_wait > 0:
+        path = f"runsync?wait={int(sync_wait * 1000)}"
+        timeout = sync_wait + 30
+    else:
+        path, timeout = "run", 60
+
+    response = api_request(session, "POST", path, json=payload, timeout=timeout, stream=True)
+
+    if response.status_code != 200:
+        print(f"Error submitting job: {response.status_code}")
+        print(response.text)
+        return None
+
+    # A /runsync response can already hold every image
+    job = read_response(response, output_dir)
+    if not job.get("id"):
+        print(f"Error: No job ID returned: {job}")
+        discard_decoded_images(job)
+        return None
+
+    return job
+
+
+def wait_for_job(session, job, output_dir, label=""):
+    """Poll /status until the job finishes; returns the final status data or None"""
+    job_id = job["id"]
+    status_data = job
+    job_status = job.get("status")
+    last_status = None
+    delay = POLL_INITIAL
+
+    while job_status not in FINISHED_STATUSES:
+        if job_status != last_status:
+            print(f"{label}Status: {job_status}")
+
+        delay = next_poll_delay(delay, job_status, last_status)
+        last_status = job_status
+        time.sleep(jitter(delay))
+
+        status_response = api_request(session, "GET", f"status/{job_id}", stream=True)
+
+        if status_response.status_code != 200:
+            print(f"Error checking status: {status_response.status_code}")
+            return None
+
+        status_data = read_response(status_response, output_dir)
+        job_status = status_data.get("status")
+
+    print(f"{label}Status: {job_status}")
+    return status_data
+
+
+def collect_outputs(status_data):
+    """Return (images, s3_urls, failed) from a finished job's status data"""
+    if status_data.get("status") != "COMPLETED":
+        print(f"Job {status_data.get('status')}")
+        print(status_data)
+        return [], [], True
+
+    output = status_data.get("output", {})
+
+    # Streaming workers return every chunk as a list
+    chunks = output if isinstance(output, list) else [output]
+
+    images = []
+    s3_urls = []
+    failed = False
+    for chunk in chunks:
+        failed = report_error(chunk) or failed
+        images.extend(chunk.get("images", []))
+        s3_urls.extend(chunk.get("s3_urls", []))
+
+    return images, s3_urls, failed
+
+
+def run_job(session, name, workflow, output_dir, models=None, reference_dir=None, stream=False,
+            sync_wait=RUNSYNC_WAIT, s3_upload=None):
+    """
+    Submit one workflow, wait for it and save its images; returns a result record
+
+    Reference images the worker reports as not cached (need_bytes) are
+    resent with data once.
+    """
     payload = {
         "input": {
             "workflow": workflow,
@@ -88,131 +630,221 @@ def send_workflow(workflow_file, models=None, output_dir="./outputs", reference_
     if models:
         payload["input"]["models"] = models
 
-    # Add reference images if specified
-    if reference_dir:
-        print(f"\nUploading reference images from: {reference_dir}")
-        reference_images = upload_reference_images(reference_dir)
+    # The worker uploads to S3 and returns URLs, which are downloaded in parallel
+    if s3_upload:
+        payload["input"]["s3_upload"] = s3_upload
+        payload["input"]["return_base64"] = False
+
+    start_time = time.time()
+    result = {"name": name, "job_id": None, "status": "SUBMIT_FAILED", "images": []}
+    resend = set()
+
+    for attempt in range(2):
+        result["status"] = "SUBMIT_FAILED"
+        reference_images = upload_reference_images(reference_dir, workflow, resend) if reference_dir else {}
         if reference_images:
             payload["input"]["reference_images"] = reference_images
-            print(f"  Total reference images: {len(reference_images)}")
-        else:
-            print("  No reference images found")
 
-    # API endpoint - Queue mode uses api.runpod.ai/v2/{id}/run
-    url = f"https://api.runpod.ai/v2/{RUNPOD_ENDPOINT_ID}/run"
+        # Streaming needs the async /run endpoint to read chunks as they arrive
+        job = submit_job(session, payload, output_dir, 0 if stream else sync_wait)
+        if not job:
+            return result
 
-    headers = {
-        "Authorization": f"Bearer {RUNPOD_API_KEY}",
-        "Content-Type": "application/json"
-    }
+        job_id = job["id"]
+        print(f"[{name}] Job submitted! ID: {job_id}")
+        result["job_id"] = job_id
 
-    print(f"Sending workflow to RunPod endpoint: {RUNPOD_ENDPOINT_ID}")
-    print(f"Workflow: {workflow_file}")
-    print(f"Using Queue mode")
-
-    # Submit job
-    print("Submitting job...")
-    response = requests.post(url, json=payload, headers=headers)
+        # Only the first attempt can ask for bytes; a second request is reported as an error
+        need_bytes = set() if attempt == 0 else None
 
-    if response.status_code != 200:
-        print(f"Error submitting job: {response.status_code}")
-        print(response.text)
-        return
+        if stream:
+            result["images"], result["status"] = stream_results(session, job_id, output_dir, need_bytes)
+        else:
+            status_data = wait_for_job(session, job, output_dir, f"[{name}] ")
+            if status_data is None:
+                # The job was accepted; only following it failed
+                result["status"] = "STATUS_FAILED"
+                break
+            if need_bytes is not None:
+                need_bytes.update(find_need_bytes(status_data.get("output")))
+
+            if not need_bytes:
+                result["status"] = status_data.get("status")
+                images, s3_urls, failed = collect_outputs(status_data)
+                if failed:
+                    result["status"] = "FAILED"
+                else:
+                    print(f"[{name}] Received {len(images) or len(s3_urls)} images!")
+                    result["images"] = save_images(images, output_dir) + download_urls(s3_urls, output_dir)
+
+            # Failed and need_bytes responses never reach save_images
+            discard_decoded_images(status_data)
+
+        if not need_bytes:
+            break
 
-    result = response.json()
-    job_id = result.get("id")
+        # The worker's cache no longer holds these; stop sending them hash-only
+        print(f"[{name}] Worker is missing {len(need_bytes)} reference images, resending with data")
+        update_seen_references(remove=need_bytes)
+        resend = need_bytes
 
-    if not job_id:
-        print("Error: No job ID returned")
-        print(result)
-        return
+    if result["status"] == "COMPLETED" and reference_images:
+        update_seen_references(add=[reference["sha256"] for reference in reference_images.values()])
 
-    print(f"Job submitted! ID: {job_id}")
-    print("Waiting for completion...")
+    result["seconds"] = round(time.time() - start_time, 1)
+    return result
 
-    # Poll for results
-    status_url = f"https://api.runpod.ai/v2/{RUNPOD_ENDPOINT_ID}/status/{job_id}"
 
-    while True:
-        time.sleep(2)
+def record_result(results_file, result):
+    """Append one finished job to the batch's results.jsonl"""
+    with results_lock:
+        with open(results_file, "a") as f:
+            f.write(json.dumps(result) + "\n")
 
-        status_response = requests.get(status_url, headers=headers)
 
-        if status_response.status_code != 200:
-            print(f"Error checking status: {status_response.status_code}")
-            break
+def send_batch(jobs, output_dir="./outputs", reference_dir=None, concurrency=4, stream=False,
+               sync_wait=RUNSYNC_WAIT, s3_upload=None):
+    """
+    Run many workflows at once with bounded concurrency
 
-        status_data = status_response.json()
-        job_status = status_data.get("status")
+    Each job's images go to output_dir/<name>/ and a line is appended to
+    output_dir/results.jsonl as soon as that job finishes.
+    """
+    if not check_credentials():
+        return []
+
+    os.makedirs(output_dir, exist_ok=True)
+    results_file = os.path.join(output_dir, "results.jsonl")
+    session = create_session(concurrency)
+    start_time = time.time()
+    results = []
+
+    print(f"Running {len(jobs)} jobs on endpoint {RUNPOD_ENDPOINT_ID}, {concurrency} at a time")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {
+            pool.submit(
+                run_job, session, name, workflow, os.path.join(output_dir, name),
+                reference_dir=reference_dir, stream=stream, sync_wait=sync_wait, s3_upload=s3_upload
+            ): name
+            for name, workflow in jobs
+        }
 
-        print(f"Status: {job_status}")
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"name": futures[future], "job_id": None, "status": "ERROR", "error": str(e), "images": []}
+            record_result(results_file, result)
+            results.append(result)
+            print(f"[{result['name']}] {result['status']} ({len(results)}/{len(jobs)} done)")
 
-        if job_status == "COMPLETED":
-            output = status_data.get("output", {})
+    failed = [result for result in results if result["status"] != "COMPLETED"]
+    print(f"\nFinished {len(jobs)} jobs in {time.time() - start_time:.0f}s, {len(failed)} failed")
+    print(f"Results: {results_file}")
+    return results
 
-            if "error" in output:
-                print(f"Job failed with error: {output['error']}")
-                if "traceback" in output:
-                    print(f"Traceback: {output['traceback']}")
-                break
 
-            images = output.get("images", [])
-            print(f"\nReceived {len(images)} images!")
+def send_workflow(workflow_file, models=None, output_dir="./outputs", reference_dir=None, stream=False,
+                  sync_wait=RUNSYNC_WAIT, s3_upload=None):
+    """
+    Send workflow to RunPod serverless endpoint
 
-            # Save images
-            os.makedirs(output_dir, exist_ok=True)
-            saved_images = []
+    Args:
+        workflow_file: Path to ComfyUI workflow JSON file
+        models: Optional dict of models to use
+        output_dir: Directory to save output images
+        reference_dir: Optional directory holding the images the workflow's LoadImage nodes read
+        stream: Save images from /stream as each output node finishes
+        sync_wait: Seconds to wait on /runsync before falling back to /status polling
+        s3_upload: Optional {"bucket", "prefix"}; results come back as S3 URLs
+    """
+    if not check_credentials():
+        return
 
-            for i, image_data in enumerate(images):
-                filename = image_data.get("filename", f"output_{i}.png")
-                image_base64 = image_data.get("data", "")
+    # Read workflow
+    with open(workflow_file, 'r') as f:
+        workflow = json.load(f)
 
-                output_path = os.path.join(output_dir, filename)
+    # Only the images the workflow loads are sent, hash-only if the endpoint has them
+    if reference_dir:
+        print(f"\nUploading reference images from: {reference_dir}")
+        if not find_workflow_images(workflow):
+            print("  Workflow has no LoadImage nodes")
 
-                with open(output_path, "wb") as f:
-                    f.write(base64.b64decode(image_base64))
+    print(f"Sending workflow to RunPod endpoint: {RUNPOD_ENDPOINT_ID}")
+    print(f"Workflow: {workflow_file}")
+    print("Waiting for completion...")
 
-                print(f"Saved: {output_path}")
-                saved_images.append(output_path)
+    result = run_job(
+        create_session(), Path(workflow_file).stem, workflow, output_dir,
+        models=models, reference_dir=reference_dir, stream=stream, sync_wait=sync_wait,
+        s3_upload=s3_upload
+    )
 
-            # Open all images
-            print("\nOpening images...")
-            for image_path in saved_images:
-                open_image(image_path)
+    if result["status"] != "COMPLETED":
+        return
 
-            print("\nDone!")
-            break
+    # Open all images
+    print("\nOpening images...")
+    for image_path in result["images"]:
+        open_image(image_path)
 
-        elif job_status in ["FAILED", "CANCELLED"]:
-            print(f"Job {job_status}")
-            print(status_data)
-            break
+    print("\nDone!")
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python send-to-runpod.py <workflow.json> [output_dir] [reference_dir]")
-        print("")
-        print("Environment variables:")
-        print("  RUNPOD_API_KEY      - Your RunPod API key")
-        print("  RUNPOD_ENDPOINT_ID  - Your RunPod endpoint ID")
-        print("")
-        print("Arguments:")
-        print("  workflow.json   - ComfyUI workflow file")
-        print("  output_dir      - Directory to save output images (default: ./outputs)")
-        print("  reference_dir   - Directory with reference images to upload (optional)")
-        print("")
-        print("Example:")
-        print("  export RUNPOD_API_KEY='your-key'")
-        print("  export RUNPOD_ENDPOINT_ID='your-endpoint-id'")
-        print("  python send-to-runpod.py workflow_api.json ./outputs ./samples")
+    parser = argparse.ArgumentParser(
+        description="Send ComfyUI workflows to a RunPod serverless endpoint",
+        epilog="Environment: RUNPOD_API_KEY and RUNPOD_ENDPOINT_ID must be set.\n\n"
+               "Examples:\n"
+               "  python send-to-runpod.py workflow_api.json ./outputs ./samples\n"
+               "  python send-to-runpod.py --batch tiles/*.json -o ./outputs --concurrency 8\n"
+               "  python send-to-runpod.py workflow_api.json --seeds 100-149 --concurrency 10",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("workflow", nargs="?", help="ComfyUI workflow file (API format)")
+    parser.add_argument("output_dir", nargs="?", default="./outputs", help="Directory to save output images")
+    parser.add_argument("reference_dir", nargs="?", help="Directory with reference images to upload")
+    parser.add_argument("--batch", nargs="+", metavar="WORKFLOW", help="Run many workflow files concurrently")
+    parser.add_argument("--seeds", help="Seed sweep, e.g. 1,2,3 or 100-149 (one job per seed)")
+    parser.add_argument("--prompts", help="File with one positive prompt per line (one job per prompt)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Jobs in flight at once in batch mode")
+    parser.add_argument("-o", "--output", help="Output directory (overrides output_dir)")
+    parser.add_argument("-r", "--references", help="Reference image directory (overrides reference_dir)")
+    parser.add_argument("--sync-wait", type=float, default=RUNSYNC_WAIT,
+                        help="Seconds to wait on /runsync before polling /status; 0 uses /run (default: %(default)s)")
+    parser.add_argument("--s3-bucket", help="Have the worker upload results to this bucket and download them from S3")
+    parser.add_argument("--s3-prefix", default="", help="Key prefix for --s3-bucket uploads")
+    parser.add_argument("--stream", action="store_true",
+                        help="Save images as each output node finishes (worker needs STREAM_OUTPUTS=1)")
+    args = parser.parse_args()
+
+    workflow_files = (args.batch or []) + ([args.workflow] if args.workflow else [])
+    if not workflow_files:
+        parser.print_help()
         sys.exit(1)
 
-    workflow_file = sys.argv[1]
-    output_dir = sys.argv[2] if len(sys.argv) > 2 else "./outputs"
-    reference_dir = sys.argv[3] if len(sys.argv) > 3 else None
-
-    send_workflow(workflow_file, output_dir=output_dir, reference_dir=reference_dir)
+    output_dir = args.output or args.output_dir
+    reference_dir = args.references or args.reference_dir
+    s3_upload = {"bucket": args.s3_bucket, "prefix": args.s3_prefix} if args.s3_bucket else None
+
+    if args.batch or args.seeds or args.prompts:
+        prompts = None
+        if args.prompts:
+            with open(args.prompts) as f:
+                prompts = [line.strip() for line in f if line.strip()]
+
+        jobs = build_batch(workflow_files, parse_seeds(args.seeds) if args.seeds else None, prompts)
+        results = send_batch(
+            jobs, output_dir, reference_dir, args.concurrency, args.stream, args.sync_wait, s3_upload
+        )
+        sys.exit(1 if any(result["status"] != "COMPLETED" for result in results) else 0)
+
+    send_workflow(
+        workflow_files[0], output_dir=output_dir, reference_dir=reference_dir,
+        stream=args.stream, sync_wait=args.sync_wait, s3_upload=s3_upload
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Load-test the RunPod handler against the fake ComfyUI server
+
+Runs the API-format workflows in workflows/ through handler() at a fixed
+concurrency with no GPU, and reports throughput, latency percentiles and
+where the handler spends time outside ComfyUI. Models referenced by the
+workflows are created as empty files and LoadImage inputs are sent as
+reference images, so the full request path runs.
+
+Usage:
+    python scripts/benchmark_handler.py --concurrency 4 --jobs 40
+    python scripts/benchmark_handler.py --latency-scale 0 --output-format webp --json results.json
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import types
+import base64
+import asyncio
+import argparse
+import tempfile
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "docker"))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from fake_comfyui import FakeComfyUI, make_png
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def load_workflows(pattern):
+    """(name, workflow) for every API-format workflow matching the glob"""
+    workflows = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            workflow = json.load(f)
+        # UI-format exports have a "nodes" list and can't be queued
+        if isinstance(workflow, dict) and "nodes" not in workflow:
+            workflows.append((os.path.basename(path), workflow))
+    return workflows
+
+
+def configure_environment(root, server_url, args):
+    """Point the handler at the fake server and scratch folders before it's imported"""
+    os.environ.update({
+        "COMFYUI_URL": server_url,
+        "COMFYUI_PATH": os.path.join(root, "comfyui"),
+        "MAX_CONCURRENCY": str(args.concurrency),
+        "WARMUP_CHECKPOINTS": "none",
+        "READAHEAD_MODELS": "none",
+        "LOCAL_MODEL_DIR": "",
+        "MODEL_MANIFEST": os.path.join(root, "no_manifest.json"),
+        "MODEL_PATHS_CONFIG": os.path.join(root, "no_model_paths.yaml"),
+        "INPUT_CACHE_DIR": os.path.join(root, "cache", "inputs"),
+        "RESULT_CACHE_DIR": os.path.join(root, "cache", "results") if args.cache else "",
+        "RESIDENCY_MANAGER": "0",
+    })
+
+    # The handler imports runpod at module level; only its logger is used here
+    try:
+        import runpod  # noqa: F401
+    except ImportError:
+        runpod_stub = types.ModuleType("runpod")
+        runpod_stub.RunPodLogger = lambda: types.SimpleNamespace()
+        sys.modules["runpod"] = runpod_stub
+
+
+def prepare_models(models, root, workflows):
+    """Create empty files for every model the workflows load, in the folders the handler checks"""
+    models_root = os.path.join(root, "models")
+    for model_type in set(models.model_dirs) | set(models.DEFAULT_MODEL_TYPES):
+        models.model_dirs[model_type] = os.path.join(models_root, model_type)
+
+    for _, workflow in workflows:
+        for model_type, name in models.find_workflow_models(workflow):
+            path = models.get_model_path(model_type, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "a").close()
+
+
+def build_job(index, name, workflow, args, image_data):
+    """A handler job for one workflow, with every LoadImage input sent as a reference image"""
+    reference_images = {}
+    for node_data in workflow.values():
+        if node_data.get("class_type") == "LoadImage":
+            reference_images[os.path.basename(node_data["inputs"]["image"])] = image_data
+
+    job_input = {
+        "workflow": workflow,
+        "return_base64": not args.no_base64,
+        "output_format": args.output_format,
+    }
+    if reference_images:
+        job_input["reference_images"] = reference_images
+    if not args.cache:
+        job_input["cache"] = "bypass"
+
+    return {"id": f"bench-{index:05}-{os.path.splitext(name)[0]}", "input": job_input}
+
+
+async def run_jobs(handler, jobs, concurrency):
+    """Run jobs through handler() with at most concurrency in flight; returns per-job records"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job):
+        async with semaphore:
+            start_time = time.perf_counter()
+            result = await handler.handler(job)
+            return {"job_id": job["id"], "latency_ms": (time.perf_counter() - start_time) * 1000, "result": result}
+
+    return await asyncio.gather(*(run(job) for job in jobs))
+
+
+def summarize(records, wall_seconds):
+    """Throughput, latency percentiles and mean per-stage time for successful jobs"""
+    succeeded = [record for record in records if "error" not in record["result"]]
+    failed = [record for record in records if "error" in record["result"]]
+    latencies = [record["latency_ms"] for record in succeeded]
+
+    summary = {
+        "jobs": len(records),
+        "failed": len(failed),
+        "wall_s": round(wall_seconds, 3),
+        "jobs_per_s": round(len(succeeded) / wall_seconds, 3) if wall_seconds else 0,
+    }
+    if failed:
+        summary["first_error"] = failed[0]["result"].get("error")
+
+    if not latencies:
+        return summary
+
+    summary["latency_ms"] = {
+        "p50": round(percentile(latencies, 0.50), 1),
+        "p95": round(percentile(latencies, 0.95), 1),
+        "p99": round(percentile(latencies, 0.99), 1),
+        "max": round(max(latencies), 1),
+    }
+
+    # Overhead is everything the handler did outside queue wait and execution
+    stages = {}
+    overheads = []
+    for record in succeeded:
+        timings = record["result"].get("timings", {})
+        stage_times = timings.get("stages_ms", {})
+        for stage, ms in stage_times.items():
+            stages.setdefault(stage, []).append(ms)
+        comfyui_ms = stage_times.get("queue_wait", 0) + stage_times.get("execution", 0)
+        overheads.append(timings.get("total_ms", 0) - comfyui_ms)
+
+    summary["stages_ms"] = {
+        stage: {"mean": round(sum(values) / len(values), 2), "p95": round(percentile(values, 0.95), 2)}
+        for stage, values in sorted(stages.items())
+    }
+    summary["overhead_ms"] = {
+        "mean": round(sum(overheads) / len(overheads), 2),
+        "p95": round(percentile(overheads, 0.95), 2),
+    }
+
+    return summary
+
+
+def print_summary(summary):
+    print(f"\nJobs: {summary['jobs']} ({summary['failed']} failed) in {summary['wall_s']}s "
+          f"= {summary['jobs_per_s']} jobs/s")
+    if "first_error" in summary:
+        print(f"First error: {summary['first_error']}")
+    if "latency_ms" not in summary:
+        return
+
+    latency = summary["latency_ms"]
+    print(f"Latency ms: p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}")
+    print(f"Handler overhead ms (total - queue_wait - execution): "
+          f"mean {summary['overhead_ms']['mean']}  p95 {summary['overhead_ms']['p95']}")
+    print("\nStage                 mean ms     p95 ms")
+    for stage, values in summary["stages_ms"].items():
+        print(f"{stage:<20} {values['mean']:>9} {values['p95']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark handler() against the fake ComfyUI server")
+    parser.add_argument("--workflows", default=os.path.join(REPO_DIR, "workflows", "*.json"))
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--jobs", type=int, default=None, help="Total jobs (default: each workflow once)")
+    parser.add_argument("--warmup", type=int, default=2, help="Jobs run first and left out of the results")
+    parser.add_argument("--latency-scale", type=float, default=0.1, help="Scale the fake server's node latencies")
+    parser.add_argument("--image-size", type=int, default=512, help="Size of the fake output images")
+    parser.add_argument("--output-format", default="raw")
+    parser.add_argument("--no-base64", action="store_true", help="Return file paths instead of image data")
+    parser.add_argument("--cache", action="store_true", help="Enable the result cache (repeat jobs become hits)")
+    parser.add_argument("--json", help="Also write the summary to this file")
+    args = parser.parse_args()
+
+    workflows = load_workflows(args.workflows)
+    if not workflows:
+        print(f"No API-format workflows match {args.workflows}")
+        sys.exit(1)
+
+    root = tempfile.mkdtemp(prefix="handler-bench-")
+    server = FakeComfyUI(
+        os.path.join(root, "comfyui", "output"),
+        os.path.join(root, "comfyui", "input"),
+        port=0,
+        latency_scale=args.latency_scale,
+        image_size=args.image_size
+    ).start()
+    os.makedirs(server.input_dir, exist_ok=True)
+
+    configure_environment(root, server.url, args)
+    import models
+    import handler
+
+    prepare_models(models, root, workflows)
+    handler.init_worker()
+
+    image_data = base64.b64encode(make_png(256)).decode()
+    total = args.jobs or len(workflows)
+    jobs = [build_job(i, *workflows[i % len(workflows)], args, image_data) for i in range(args.warmup + total)]
+
+    print(f"Running {args.warmup} warm-up + {total} jobs from {len(workflows)} workflows "
+          f"at concurrency {args.concurrency} (server {server.url}, scratch {root})")
+
+    asyncio.run(run_jobs(handler, jobs[:args.warmup], args.concurrency))
+
+    start_time = time.perf_counter()
+    records = asyncio.run(run_jobs(handler, jobs[args.warmup:], args.concurrency))
+    summary = summarize(records, time.perf_counter() - start_time)
+
+    print_summary(summary)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    server.stop()
+    sys.exit(1 if summary["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
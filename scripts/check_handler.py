@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Behaviour checks for the handler against the fake ComfyUI server
+
+Each check sets up a scenario the load test doesn't cover and asserts on
+the result. Runs every check by default, or the ones named on the command
+line.
+
+Usage:
+    python scripts/check_handler.py
+    python scripts/check_handler.py cache_key_survives_promotion
+"""
+
+import os
+import sys
+import time
+import json
+import types
+import asyncio
+import hashlib
+import tempfile
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "docker"))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from fake_comfyui import FakeComfyUI
+
+CHECKS = {}
+
+
+def check(function):
+    """Register a check under its function name"""
+    CHECKS[function.__name__] = function
+    return function
+
+
+def configure_environment(root, server_url):
+    """Point the handler at the fake server and scratch folders, with the local model tier on"""
+    os.environ.update({
+        "COMFYUI_URL": server_url,
+        "COMFYUI_PATH": os.path.join(root, "comfyui"),
+        "WARMUP_CHECKPOINTS": "none",
+        "READAHEAD_MODELS": "none",
+        "LOCAL_MODEL_DIR": os.path.join(root, "local-models"),
+        "MODEL_MANIFEST": os.path.join(root, "no_manifest.json"),
+        "MODEL_PATHS_CONFIG": os.path.join(root, "no_model_paths.yaml"),
+        "INPUT_CACHE_DIR": os.path.join(root, "cache", "inputs"),
+        "RESULT_CACHE_DIR": os.path.join(root, "cache", "results"),
+    })
+
+    # The handler imports runpod at module level; only its logger is used here
+    try:
+        import runpod  # noqa: F401
+    except ImportError:
+        runpod_stub = types.ModuleType("runpod")
+        runpod_stub.RunPodLogger = lambda: types.SimpleNamespace()
+        sys.modules["runpod"] = runpod_stub
+
+
+def create_model(models, model_type, name, size=1024, mtime=None):
+    """Write a model file on the stand-in volume and return its path"""
+    path = models.get_model_path(model_type, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+@check
+def cache_key_survives_promotion(env):
+    """Copying a model to the local tier and using it there must not change the result cache key"""
+    handler, models = env.handler, env.models
+    create_model(models, "checkpoints", "promoted.safetensors", mtime=time.time() - 3600)
+    workflow = {"1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "promoted.safetensors"}}}
+
+    before = handler.workflow_cache_key(workflow, [])
+
+    models.copy_to_local_tier("checkpoints", "promoted.safetensors")
+    assert os.path.exists(models.local_model_path("checkpoints", "promoted.safetensors")), "model was not promoted"
+    promoted = handler.workflow_cache_key(workflow, [])
+
+    time.sleep(1.1)
+    models.promote_models([("checkpoints", "promoted.safetensors")])
+    used = handler.workflow_cache_key(workflow, [])
+
+    assert before == promoted == used, f"cache key changed: {before[:12]} {promoted[:12]} {used[:12]}"
+
+
+@check
+def residency_tracks_comfyui_evictions(env):
+    """Alternating pipelines: models ComfyUI unloaded on its own must not be counted as resident"""
+    handler, models, server = env.handler, env.models, env.server
+    residency = handler.residency
+    megabyte = 1024 ** 2
+    names = ["pipeline_a.safetensors", "pipeline_b.safetensors", "pipeline_c.safetensors"]
+    for name in names:
+        create_model(models, "checkpoints", name, size=10 * megabyte)
+
+    # The stand-in needs more working memory than the manager budgets for, so it evicts on its own
+    saved = (server.vram_total, server.working_bytes, server.model_size, residency.enabled, residency.overhead_bytes)
+    server.vram_total, server.working_bytes = 24 * megabyte, 6 * megabyte
+    server.model_size = lambda class_type, inputs: models.get_model_size("checkpoints", inputs["ckpt_name"]) or 0
+    residency.enabled, residency.overhead_bytes = True, 2 * megabyte
+    residency.resident.clear()
+    server.loaded_models.clear()
+    server.evictions = 0
+
+    stale = []
+    prepare = residency.prepare
+
+    def checked_prepare(required):
+        freed = prepare(required)
+        loaded = {json.loads(inputs).get("ckpt_name") for _, inputs in list(server.loaded_models)}
+        believed = {name for _, name in residency.resident}
+        if not believed <= loaded:
+            stale.append(sorted(believed - loaded))
+        return freed
+
+    residency.prepare = checked_prepare
+    try:
+        for index, name in enumerate(names * 2 + names[:1]):
+            workflow = {
+                "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": name}},
+                "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "residency", "images": ["1", 0]}},
+            }
+            result = asyncio.run(handler.handler({"id": f"residency-{index}", "input": {
+                "workflow": workflow, "cache": "bypass", "return_base64": False
+            }}))
+            assert "error" not in result, result.get("error")
+    finally:
+        del residency.prepare
+        (server.vram_total, server.working_bytes, server.model_size,
+         residency.enabled, residency.overhead_bytes) = saved
+
+    assert server.evictions, "the stand-in never had to evict, so the scenario proved nothing"
+    assert not stale, f"manager counted unloaded models as resident: {stale}"
+
+
+class FakeS3:
+    """Just enough of a boto3 S3 client to record what the handler uploads"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, filepath, bucket, key, Config=None):
+        with open(filepath, "rb") as f:
+            self.objects[(bucket, key)] = f.read()
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        self.objects[(bucket, key)] = fileobj.read()
+
+    def head_object(self, Bucket, Key):
+        from botocore.exceptions import ClientError
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {}
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://s3.invalid/{Params['Bucket']}/{Params['Key']}"
+
+
+@check
+def s3_objects_match_output_format(env):
+    """S3 uploads carry the encoded output, not ComfyUI's PNG"""
+    import utils
+
+    fake_s3 = FakeS3()
+    utils.s3_client = fake_s3
+    workflow = {"9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "s3check", "images": ["8", 0]}},
+                "8": {"class_type": "EmptyLatentImage", "inputs": {}}}
+
+    for content_addressed in (False, True):
+        result = asyncio.run(env.handler.handler({"id": f"s3check-{content_addressed}", "input": {
+            "workflow": workflow,
+            "output_format": "webp",
+            "cache": "bypass",
+            "s3_upload": {"bucket": "bucket", "prefix": "out/", "content_addressed": content_addressed},
+        }}))
+        assert "error" not in result, result.get("error")
+        assert result["images"][0]["filename"].endswith(".webp"), result["images"][0]["filename"]
+
+    assert len(fake_s3.objects) == 2, list(fake_s3.objects)
+    for (bucket, key), data in fake_s3.objects.items():
+        assert key.endswith(".webp") and data[:4] == b"RIFF", f"{key} is not WebP"
+        if "s3check" not in key:
+            assert key == f"out/{hashlib.sha256(data).hexdigest()}.webp", f"{key} doesn't match its bytes"
+
+
+def main():
+    names = sys.argv[1:] or list(CHECKS)
+    unknown = [name for name in names if name not in CHECKS]
+    if unknown:
+        print(f"Unknown checks: {unknown}; available: {list(CHECKS)}")
+        sys.exit(2)
+
+    root = tempfile.mkdtemp(prefix="handler-check-")
+    server = FakeComfyUI(
+        os.path.join(root, "comfyui", "output"),
+        os.path.join(root, "comfyui", "input"),
+        port=0,
+        latency_scale=0
+    ).start()
+    os.makedirs(server.input_dir, exist_ok=True)
+
+    configure_environment(root, server.url)
+    import models
+    import handler
+
+    for model_type in set(models.model_dirs) | set(models.DEFAULT_MODEL_TYPES):
+        models.model_dirs[model_type] = os.path.join(root, "volume", model_type)
+
+    # The handler creates the local tier when it writes ComfyUI's model paths config
+    os.makedirs(models.LOCAL_MODEL_DIR, exist_ok=True)
+
+    env = types.SimpleNamespace(root=root, server=server, handler=handler, models=models)
+    failed = 0
+
+    for name in names:
+        try:
+            CHECKS[name](env)
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL {name}: {e}")
+        else:
+            print(f"ok   {name}")
+
+    server.stop()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
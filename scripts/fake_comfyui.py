@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+"""
+Stand-in ComfyUI server for testing the handler without a GPU
+
+Implements the parts of ComfyUI's API the handler uses - /prompt,
+/history, /view, /queue, /interrupt, /free, /system_stats, /object_info and
+the /ws event stream - with the standard library only. Prompts run one at
+a time like in ComfyUI: each node sleeps for a simulated latency and
+SaveImage nodes write a dummy PNG to the output directory.
+
+Usage:
+    python scripts/fake_comfyui.py --output-dir /tmp/comfyui/output --port 8188
+    COMFYUI_URL=http://localhost:8188 COMFYUI_PATH=/tmp/comfyui python docker/handler.py
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import base64
+import struct
+import hashlib
+import argparse
+import threading
+from collections import deque, OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Simulated seconds per node, before --latency-scale; other nodes take DEFAULT_LATENCY
+NODE_LATENCIES = {
+    "KSampler": 0.5,
+    "KSamplerAdvanced": 0.5,
+    "VAEDecode": 0.05,
+    "VAEDecodeTiled": 0.1,
+    "VAEEncode": 0.05,
+    "CheckpointLoaderSimple": 0.3,
+    "ControlNetLoader": 0.1,
+    "LoraLoader": 0.05,
+    "VAELoader": 0.05,
+    "UpscaleModelLoader": 0.05,
+    "SaveImage": 0.02,
+}
+DEFAULT_LATENCY = 0.002
+
+# Loaders are only slow the first time, like ComfyUI's model cache
+LOADER_NODES = {"CheckpointLoaderSimple", "ControlNetLoader", "LoraLoader", "VAELoader", "UpscaleModelLoader"}
+
+# Reported by /object_info so the handler's class_type check passes
+NODE_TYPES = sorted(set(NODE_LATENCIES) | {
+    "CLIPTextEncode", "EmptyLatentImage", "LoadImage", "PreviewImage", "ImageCrop", "ImageScale",
+    "ImageConcanate", "ImageToMask", "CreateShapeMask", "SetLatentNoiseMask", "ControlNetApply",
+    "LoraLoaderModelOnly", "CLIPVisionLoader", "ImageUpscaleWithModel",
+})
+
+
+def make_png(size):
+    """
+    A size x size RGB PNG of random pixels
+
+    Noise doesn't compress, so files are about as large as real renders.
+    """
+    row_bytes = size * 3
+    raw = b"".join(b"\x00" + os.urandom(row_bytes) for _ in range(size))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+def topological_order(prompt):
+    """Node ids ordered so every node comes after the nodes it links to"""
+    order = []
+    visited = set()
+
+    def visit(node_id):
+        if node_id in visited or node_id not in prompt:
+            return
+        visited.add(node_id)
+        for value in prompt[node_id].get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                visit(str(value[0]))
+        order.append(node_id)
+
+    for node_id in prompt:
+        visit(node_id)
+
+    return order
+
+
+class WebSocketClient:
+    """One /ws connection; the server only ever sends unmasked text frames"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        payload = json.dumps(message).encode()
+        if len(payload) < 126:
+            header = struct.pack(">BB", 0x81, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack(">BBH", 0x81, 126, len(payload))
+        else:
+            header = struct.pack(">BBQ", 0x81, 127, len(payload))
+
+        with self.lock:
+            self.sock.sendall(header + payload)
+
+    def read_frames(self):
+        """Consume client frames until it closes; answers pings and close"""
+        stream = self.sock.makefile("rb")
+        while True:
+            header = stream.read(2)
+            if len(header) < 2:
+                return
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack(">H", stream.read(2))[0]
+            elif length == 127:
+                length = struct.unpack(">Q", stream.read(8))[0]
+            mask = stream.read(4) if header[1] & 0x80 else b"\x00" * 4
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(stream.read(length)))
+
+            with self.lock:
+                if opcode == 0x8:
+                    self.sock.sendall(struct.pack(">BB", 0x88, len(payload)) + payload)
+                    return
+                if opcode == 0x9:
+                    self.sock.sendall(struct.pack(">BB", 0x8A, len(payload)) + payload)
+
+
+class FakeComfyUI:
+    """The server state and the single prompt worker"""
+
+    def __init__(self, output_dir, input_dir=None, port=8188, latency_scale=1.0, image_size=512,
+                 vram_total=24 * 1024 ** 3, model_size=None, working_bytes=0):
+        """
+        model_size(class_type, inputs) gives the VRAM a loader node's model
+        takes (default 0). Loading one evicts least recently used models until
+        it fits alongside working_bytes, the way ComfyUI frees memory itself.
+        """
+        self.output_dir = output_dir
+        self.input_dir = input_dir
+        self.port = port
+        self.latency_scale = latency_scale
+        self.image_size = image_size
+        self.vram_total = vram_total
+        self.model_size = model_size or (lambda class_type, inputs: 0)
+        self.working_bytes = working_bytes
+
+        self.pending = deque()
+        self.running = None
+        self.history = {}
+        self.clients = {}
+        # Loader (class_type, inputs) -> VRAM bytes, least recently used first
+        self.loaded_models = OrderedDict()
+        self.evictions = 0
+        self.number = 0
+        self.image_counter = 0
+        self.interrupted = threading.Event()
+        self.condition = threading.Condition()
+        self.png = make_png(image_size)
+        self.httpd = None
+
+    def start(self):
+        """Serve in background threads; returns once the port is bound"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", self.port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, name="fake-comfyui-http", daemon=True).start()
+        threading.Thread(target=self.prompt_worker, name="fake-comfyui-worker", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    # Events
+
+    def send_event(self, client_id, event_type, data):
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+        try:
+            client.send({"type": event_type, "data": data})
+        except OSError:
+            self.clients.pop(client_id, None)
+
+    def queue_remaining(self):
+        return len(self.pending) + (1 if self.running else 0)
+
+    # Prompt execution
+
+    def queue_prompt(self, prompt, client_id):
+        with self.condition:
+            prompt_id = str(uuid.uuid4())
+            number = self.number
+            self.number += 1
+            self.pending.append((number, prompt_id, prompt, client_id))
+            self.condition.notify()
+        return prompt_id, number
+
+    def prompt_worker(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                self.running = self.pending.popleft()
+                self.interrupted.clear()
+
+            number, prompt_id, prompt, client_id = self.running
+            try:
+                self.execute(prompt_id, prompt, client_id)
+            finally:
+                with self.condition:
+                    self.running = None
+
+    @property
+    def vram_free(self):
+        with self.condition:
+            return self.vram_total - sum(self.loaded_models.values())
+
+    def load_model(self, class_type, inputs):
+        """Mark a loader's model resident; returns False if it already was"""
+        key = (class_type, json.dumps(inputs, sort_keys=True))
+        size = self.model_size(class_type, inputs)
+
+        with self.condition:
+            if key in self.loaded_models:
+                self.loaded_models.move_to_end(key)
+                return False
+
+            while self.loaded_models and self.vram_free < size + self.working_bytes:
+                self.loaded_models.popitem(last=False)
+                self.evictions += 1
+            self.loaded_models[key] = size
+            return True
+
+    def node_latency(self, class_type, node_data):
+        if class_type in LOADER_NODES and not self.load_model(class_type, node_data.get("inputs", {})):
+            return DEFAULT_LATENCY * self.latency_scale
+        return NODE_LATENCIES.get(class_type, DEFAULT_LATENCY) * self.latency_scale
+
+    def save_image(self, node_data):
+        prefix = str(node_data.get("inputs", {}).get("filename_prefix", "ComfyUI"))
+        subfolder, name = os.path.split(prefix)
+        folder = os.path.join(self.output_dir, subfolder)
+        os.makedirs(folder, exist_ok=True)
+
+        with self.condition:
+            self.image_counter += 1
+            filename = f"{name}_{self.image_counter:05}_.png"
+
+        with open(os.path.join(folder, filename), "wb") as f:
+            f.write(self.png)
+
+        return {"images": [{"filename": filename, "subfolder": subfolder, "type": "output"}]}
+
+    def execute(self, prompt_id, prompt, client_id):
+        started = time.time()
+        outputs = {}
+        messages = [["execution_start", {"prompt_id": prompt_id, "timestamp": int(started * 1000)}]]
+        status_str = "success"
+
+        self.send_event(client_id, "execution_start", {"prompt_id": prompt_id})
+
+        for node_id in topological_order(prompt):
+            node_data = prompt[node_id]
+            class_type = node_data.get("class_type")
+            self.send_event(client_id, "executing", {"node": node_id, "display_node": node_id, "prompt_id": prompt_id})
+
+            # Interrupts are honoured between short sleeps, like ComfyUI between steps
+            deadline = time.time() + self.node_latency(class_type, node_data)
+            while time.time() < deadline and not self.interrupted.is_set():
+                time.sleep(min(0.01, max(deadline - time.time(), 0)))
+
+            if self.interrupted.is_set():
+                status_str = "error"
+                data = {"prompt_id": prompt_id, "node_id": node_id, "node_type": class_type, "executed": list(outputs)}
+                messages.append(["execution_interrupted", data])
+                self.send_event(client_id, "execution_interrupted", data)
+                break
+
+            if class_type == "SaveImage":
+                outputs[node_id] = self.save_image(node_data)
+                self.send_event(client_id, "executed", {
+                    "node": node_id, "display_node": node_id, "output": outputs[node_id], "prompt_id": prompt_id
+                })
+
+        # As in ComfyUI: execution_success goes out before the history entry is
+        # written, and "executing" with node None only after it, so a client that
+        # reads /history on execution_success can miss the result
+        if status_str == "success":
+            messages.append(["execution_success", {"prompt_id": prompt_id}])
+            self.send_event(client_id, "execution_success", {"prompt_id": prompt_id})
+
+        self.history[prompt_id] = {
+            "prompt": [0, prompt_id, prompt, {"client_id": client_id}, list(outputs)],
+            "outputs": outputs,
+            "status": {"status_str": status_str, "completed": status_str == "success", "messages": messages}
+        }
+        self.send_event(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+        self.send_event(client_id, "status", {"status": {"exec_info": {"queue_remaining": self.queue_remaining()}}})
+
+    # HTTP
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; Nagle would stall each response
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, data, status=200):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_json(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if not length:
+                    return {}
+                return json.loads(self.rfile.read(length))
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+                if url.path == "/ws":
+                    return self.open_websocket(query.get("clientId") or uuid.uuid4().hex)
+
+                if url.path == "/system_stats":
+                    return self.send_json({
+                        "system": {"os": "fake", "python_version": sys.version, "comfyui_version": "fake"},
+                        "devices": [{
+                            "name": "fake-gpu", "type": "cuda", "index": 0,
+                            "vram_total": server.vram_total, "vram_free": server.vram_free,
+                            "torch_vram_total": 0, "torch_vram_free": 0
+                        }]
+                    })
+
+                if url.path == "/object_info":
+                    return self.send_json({node_type: {"name": node_type} for node_type in NODE_TYPES})
+
+                if url.path == "/queue":
+                    running = server.running
+                    return self.send_json({
+                        "queue_running": [list(running[:3]) + [{}, []]] if running else [],
+                        "queue_pending": [list(item[:3]) + [{}, []] for item in list(server.pending)]
+                    })
+
+                if url.path == "/history":
+                    return self.send_json(server.history)
+
+                if url.path.startswith("/history/"):
+                    prompt_id = url.path[len("/history/"):]
+                    entry = server.history.get(prompt_id)
+                    return self.send_json({prompt_id: entry} if entry else {})
+
+                if url.path == "/view":
+                    return self.send_file(query)
+
+                self.send_json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                try:
+                    data = self.read_json()
+                except ValueError:
+                    return self.send_json({"error": "invalid json"}, 400)
+
+                if url.path == "/prompt":
+                    prompt = data.get("prompt")
+                    if not isinstance(prompt, dict) or not prompt:
+                        return self.send_json({"error": {"type": "no_prompt", "message": "No prompt provided"}}, 400)
+                    prompt_id, number = server.queue_prompt(prompt, data.get("client_id"))
+                    return self.send_json({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+
+                if url.path == "/interrupt":
+                    server.interrupted.set()
+                    return self.send_json({})
+
+                if url.path == "/free":
+                    if data.get("unload_models"):
+                        with server.condition:
+                            server.loaded_models.clear()
+                    return self.send_json({})
+
+                if url.path == "/queue":
+                    with server.condition:
+                        if data.get("clear"):
+                            server.pending.clear()
+                        for prompt_id in data.get("delete", []):
+                            for item in list(server.pending):
+                                if item[1] == prompt_id:
+                                    server.pending.remove(item)
+                    return self.send_json({})
+
+                self.send_json({"error": "not found"}, 404)
+
+            def send_file(self, query):
+                folder = server.input_dir if query.get("type") == "input" else server.output_dir
+                root = os.path.realpath(folder or "")
+                path = os.path.realpath(os.path.join(root, query.get("subfolder", ""), query.get("filename", "")))
+
+                if not folder or not path.startswith(root + os.sep) or not os.path.isfile(path):
+                    return self.send_json({"error": "not found"}, 404)
+
+                with open(path, "rb") as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def open_websocket(self, client_id):
+                key = self.headers.get("Sec-WebSocket-Key")
+                if self.headers.get("Upgrade", "").lower() != "websocket" or not key:
+                    return self.send_json({"error": "expected a websocket upgrade"}, 400)
+
+                accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+
+                client = WebSocketClient(self.connection)
+                server.clients[client_id] = client
+                client.send({"type": "status", "data": {
+                    "status": {"exec_info": {"queue_remaining": server.queue_remaining()}}, "sid": client_id
+                }})
+
+                try:
+                    client.read_frames()
+                except (OSError, struct.error):
+                    pass
+                finally:
+                    if server.clients.get(client_id) is client:
+                        server.clients.pop(client_id, None)
+                    self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in ComfyUI server for handler tests")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--output-dir", default="/tmp/fake-comfyui/output")
+    parser.add_argument("--input-dir", default=None)
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiply simulated node latencies")
+    parser.add_argument("--image-size", type=int, default=512, help="Width and height of the dummy PNGs")
+    args = parser.parse_args()
+
+    server = FakeComfyUI(args.output_dir, args.input_dir, args.port, args.latency_scale, args.image_size).start()
+    print(f"Fake ComfyUI listening on {server.url}, writing outputs to {args.output_dir}")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Fill in sha256 and size for model manifest entries
+
+Hugging Face reports both for LFS files in the X-Linked-Etag and
+X-Linked-Size headers of a resolve URL, so those entries are pinned with
+one HEAD request. Other URLs are streamed and hashed. s3 entries are
+skipped.
+
+Usage:
+    python scripts/pin_model_manifest.py docker/model_manifest.json
+    python scripts/pin_model_manifest.py docker/model_manifest.json --all  # re-check pinned entries too
+"""
+
+import re
+import json
+import hashlib
+import argparse
+import requests
+
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+def linked_file_info(url):
+    """(sha256, size) from Hugging Face's LFS headers, or None if the server doesn't send them"""
+    response = requests.head(url, allow_redirects=False, timeout=30)
+    etag = response.headers.get("X-Linked-Etag", "").strip('"').lower()
+    size = response.headers.get("X-Linked-Size", "")
+
+    if SHA256_PATTERN.fullmatch(etag) and size.isdigit():
+        return etag, int(size)
+    return None
+
+
+def hash_download(url):
+    """(sha256, size) of a URL's body, streamed"""
+    digest = hashlib.sha256()
+    size = 0
+
+    with requests.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=8 * 1024 * 1024):
+            digest.update(chunk)
+            size += len(chunk)
+
+    return digest.hexdigest(), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pin sha256 and size in a model manifest")
+    parser.add_argument("manifest", help="Manifest to update in place")
+    parser.add_argument("--all", action="store_true", help="Also re-check entries that are already pinned")
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    changed = False
+    for name, entry in manifest.get("models", {}).items():
+        if "url" not in entry:
+            print(f"Skipping {name}: no url")
+            continue
+        if not args.all and entry.get("sha256") and entry.get("size"):
+            continue
+
+        print(f"Pinning {name}...")
+        info = linked_file_info(entry["url"]) or hash_download(entry["url"])
+
+        if entry.get("sha256") and entry["sha256"].lower() != info[0]:
+            print(f"  sha256 changed: {entry['sha256']} -> {info[0]}")
+        entry["sha256"], entry["size"] = info
+        print(f"  sha256 {info[0]}, {info[1]} bytes")
+        changed = True
+
+    if changed:
+        with open(args.manifest, "w") as f:
+            json.dump(manifest, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
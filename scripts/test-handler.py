@@ -7,6 +7,8 @@ Simulates what RunPod does when calling your endpoint
 import json
 import sys
 import os
+import asyncio
+import inspect
 
 # Add the docker directory to path so we can import the handler
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../docker'))
@@ -36,6 +38,8 @@ class MockRunPod:
             print("\nCalling handler with test event...")
             try:
                 result = handler_func(test_event)
+                if inspect.iscoroutine(result):
+                    result = asyncio.run(result)
                 print("\n=== RESULT ===")
                 print(json.dumps(result, indent=2)[:500])  # First 500 chars
 